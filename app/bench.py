@@ -0,0 +1,264 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import bokeh
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from bokeh.application import Application
+from bokeh.application.handlers.directory import DirectoryHandler
+from bokeh.protocol import Protocol
+
+import csvcache
+import datastore
+import instrumentation
+import matching
+
+# Microbenchmarks of startup and of every interactive callback, without a
+# browser or a server:
+#
+#   python app/bench.py [--reps 30] [--out bench.json] [--compare baseline.json]
+#   AUTO_EXPORTS_DATA_DIR=/tmp/synth python app/bench.py   # see synthdata.py
+#
+# Startup stages are timed once each, in load order. Callbacks run against a
+# session document built by the app itself: each repetition computes and
+# applies one update with varying arguments (other months, types,
+# countries), split into compute (worker pool side) and apply (document
+# side, inside one hold), and the PATCH-DOC message the server would send is
+# built and measured. The first call is reported separately, since it fills
+# the shared per-process caches. Results are JSON; --compare flags callbacks
+# whose median time or patch size grew by more than --threshold.
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_REPS = 30
+DEFAULT_THRESHOLD = 1.25
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def bench_startup():
+    # Milliseconds per load stage, plus the size of a new session's document.
+    stages = {}
+    world, stages['shapefile_read'] = timed(
+        gpd.read_file, datastore.SHAPEFILE_PATH, include_fields=datastore.WORLD_COLUMNS)
+    _, stages['csv_parse'] = timed(csvcache.parse_csv, datastore.CSV_PATH)
+    csvcache.load_csv(datastore.CSV_PATH)
+    (values, columns, _, _), stages['csv_cache_read'] = timed(csvcache.load_csv, datastore.CSV_PATH)
+    df = pd.DataFrame(values, columns=columns, copy=False)
+    country_type_value_to_col, export_types, value_types = datastore._parse_columns(df.columns)
+    series = list(country_type_value_to_col)
+    names = world[[c for c in matching.NAME_COLUMNS if c in world.columns]]
+    aliases = matching.read_aliases(datastore.ALIASES_PATH)
+    _, stages['name_matching'] = timed(matching.match_countries, series, names, aliases)
+    datastore._match_countries(world, series)
+    (filtered_world, _, country_series), stages['name_matching_cached'] = timed(
+        datastore._match_countries, world, series)
+    _, stages['cube_build'] = timed(
+        datastore._build_cube, df, country_type_value_to_col, country_series, export_types, value_types)
+
+    def build_geometry():
+        for _, tolerance, _ in datastore.LEVELS_OF_DETAIL:
+            datastore._patch_coords(datastore._simplify_coverage(filtered_world.geometry.values, tolerance))
+    _, stages['geometry_build'] = timed(build_geometry)
+
+    store, stages['store_load'] = timed(datastore.load)
+    datastore._store = store
+    app = Application(DirectoryHandler(filename=APP_DIR))
+    doc, stages['first_document'] = timed(app.create_document)
+    _, stages['next_document'] = timed(app.create_document)
+    # What the server sends a new session.
+    document_bytes = instrumentation.message_bytes(Protocol().create('PULL-DOC-REPLY', 'bench', doc))
+    return stages, document_bytes, doc
+
+
+def patch_bytes(events):
+    return instrumentation.message_bytes(Protocol().create('PATCH-DOC', events)) if events else 0
+
+
+def callback_cases(app, store):
+    # name -> (Update, iterator of compute arguments). Arguments cycle so
+    # that consecutive calls do real work instead of repeating one state.
+    months = range(len(store.dates))
+    latest = len(store.dates) - 1
+    types = list(itertools.product(store.export_types, store.value_type_options))
+    countries = sorted(store.admin_to_df_map)
+    cases = {
+        'update_map_type': (app.update_map_type, (
+            (exp_type, value_type, latest, None, False) for exp_type, value_type in itertools.cycle(types))),
+        'highlight_top15': (app.highlight_top15, (
+            (datastore.DEFAULT_TYPE, datastore.DEFAULT_VALUE_TYPE, t, 15, 1) for t in itertools.cycle(months))),
+        'highlight_top15_trailing': (app.highlight_top15, (
+            (datastore.DEFAULT_TYPE, datastore.DEFAULT_VALUE_TYPE, t, 15, 12) for t in itertools.cycle(months))),
+        'update_selected': (app.update_selected, (
+            (country, datastore.DEFAULT_TYPE, datastore.DEFAULT_VALUE_TYPE) for country in itertools.cycle(countries))),
+        'reset_top15': (app.reset_top15, (
+            (datastore.DEFAULT_TYPE, datastore.DEFAULT_VALUE_TYPE, t) for t in itertools.cycle(months))),
+    }
+    for grouping, rollup in store.rollups.items():
+        cases.update(region_cases(app, grouping, rollup, types, latest))
+    return cases
+
+
+def region_cases(app, grouping, rollup, types, latest):
+    # A function of its own, so each case's generators keep their grouping.
+    # The first call fills the region source with its outlines, as the first
+    # switch to the view does; the rest only recolor.
+    return {
+        f'update_map_type[{grouping}]': (app.update_map_type, (
+            (exp_type, value_type, latest, grouping, i == 0)
+            for i, (exp_type, value_type) in enumerate(itertools.cycle(types)))),
+        f'update_region_chart[{grouping}]': (app.update_region_chart, (
+            (grouping, region, datastore.DEFAULT_TYPE, datastore.DEFAULT_VALUE_TYPE)
+            for region in itertools.cycle(rollup.names))),
+    }
+
+
+def bench_callback(doc, update, arguments, reps):
+    events = []
+    doc.on_change(events.append)
+    runs = []
+    try:
+        for args in itertools.islice(arguments, reps + 1):
+            result, compute_ms = timed(update.compute, *args)
+            events.clear()
+            start = time.perf_counter()
+            doc.hold('combine')
+            try:
+                update.apply(result)
+            finally:
+                doc.unhold()
+            apply_ms = (time.perf_counter() - start) * 1000
+            size, serialize_ms = timed(patch_bytes, list(events))
+            runs.append((compute_ms, apply_ms, serialize_ms, size, len(events)))
+    finally:
+        doc.remove_on_change(events.append)
+    first, rest = runs[0], runs[1:] or runs[:1]
+    total = [c + a + s for c, a, s, _, _ in rest]
+    return dict(
+        reps=len(rest),
+        first_ms=sum(first[:3]),
+        median_ms=statistics.median(total),
+        p95_ms=float(np.percentile(total, 95)),
+        min_ms=min(total),
+        compute_ms=statistics.median(r[0] for r in rest),
+        apply_ms=statistics.median(r[1] for r in rest),
+        serialize_ms=statistics.median(r[2] for r in rest),
+        patch_bytes=int(statistics.median(r[3] for r in rest)),
+        patch_events=int(statistics.median(r[4] for r in rest)),
+    )
+
+
+def session_module(doc):
+    # The namespace main.py ran in for this document.
+    return doc.modules._modules[0]
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(reps):
+    stages, document_bytes, doc = bench_startup()
+    store = datastore.get_store()
+    app = session_module(doc)
+    callbacks = {name: bench_callback(doc, update, arguments, reps)
+                 for name, (update, arguments) in callback_cases(app, store).items()}
+    return dict(
+        meta=dict(
+            revision=git_revision(),
+            time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+            python=platform.python_version(),
+            bokeh=bokeh.__version__,
+            numpy=np.__version__,
+            cpus=os.cpu_count(),
+            data_dir=datastore.DATA_DIR,
+            months=len(store.dates),
+            countries=len(store.countries),
+            shapes=len(store.world),
+            cube_dtype=str(store.cube.dtype),
+        ),
+        startup_ms=stages,
+        document_bytes=document_bytes,
+        callbacks=callbacks,
+    )
+
+
+def compare(results, baseline, threshold):
+    # Rows of (name, metric, baseline, current, ratio, regressed).
+    rows = []
+    for name, current in results['callbacks'].items():
+        before = baseline.get('callbacks', {}).get(name)
+        if before is None:
+            continue
+        for metric in ('median_ms', 'patch_bytes'):
+            ratio = current[metric] / before[metric] if before[metric] else float('inf') if current[metric] else 1.0
+            rows.append((name, metric, before[metric], current[metric], ratio, ratio > threshold))
+    for stage, current in results['startup_ms'].items():
+        before = baseline.get('startup_ms', {}).get(stage)
+        if before:
+            ratio = current / before
+            rows.append((stage, 'startup_ms', before, current, ratio, ratio > threshold))
+    return rows
+
+
+def print_results(results):
+    meta = results['meta']
+    print(f"{meta['months']} months, {meta['countries']} countries, {meta['shapes']} shapes, "
+          f"{meta['cube_dtype']} cube ({meta['data_dir']})")
+    print("\nstartup (ms)")
+    for stage, ms in results['startup_ms'].items():
+        print(f"  {stage:28}{ms:10.1f}")
+    print(f"  {'document size (bytes)':28}{results['document_bytes']:10d}")
+    print(f"\n{'callback':36}{'first':>9}{'median':>9}{'p95':>9}{'compute':>9}{'apply':>9}{'bytes':>10}{'events':>7}")
+    for name, r in results['callbacks'].items():
+        print(f"{name:36}{r['first_ms']:9.2f}{r['median_ms']:9.2f}{r['p95_ms']:9.2f}"
+              f"{r['compute_ms']:9.2f}{r['apply_ms']:9.2f}{r['patch_bytes']:10d}{r['patch_events']:7d}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark app startup and callbacks.")
+    parser.add_argument('--reps', type=int, default=DEFAULT_REPS, help="repetitions per callback")
+    parser.add_argument('--out', help="write results as JSON to this file")
+    parser.add_argument('--compare', help="baseline JSON from an earlier --out")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="ratio above which --compare reports a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Layout validation warnings for every document built.
+    logging.getLogger('bokeh').setLevel(logging.ERROR)
+    results = run(args.reps)
+    print_results(results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            rows = compare(results, json.load(f), args.threshold)
+        print(f"\n{'compared to ' + args.compare:48}{'before':>12}{'now':>12}{'ratio':>8}")
+        for name, metric, before, current, ratio, regressed in rows:
+            print(f"{name + ' ' + metric:48}{before:12.2f}{current:12.2f}{ratio:8.2f}{'  REGRESSED' if regressed else ''}")
+        if any(row[-1] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
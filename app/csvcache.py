@@ -0,0 +1,185 @@
+import csv
+import hashlib
+import io
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+# Binary cache of the parsed CSV, written next to it:
+#   <name>.values.npy  float64 (date x column) matrix, memory-mapped on load
+#   <name>.meta.json   source fingerprint, column names and the date index
+# The meta file is written last and acts as the commit marker, so a reader
+# never sees a half-written cache. Both files are replaced atomically, which
+# makes the cache safe to share read-only between server worker processes.
+
+CACHE_VERSION = 1
+
+
+def cache_paths(csv_path):
+    stem = os.path.splitext(csv_path)[0]
+    return f'{stem}.values.npy', f'{stem}.meta.json'
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _fingerprint(csv_path, with_hash=True):
+    st = os.stat(csv_path)
+    return dict(size=st.st_size, mtime_ns=st.st_mtime_ns,
+                sha256=_file_sha256(csv_path) if with_hash else None)
+
+
+def changed(csv_path, source):
+    # Whether the file differs from the one fingerprinted as `source`.
+    current = _fingerprint(csv_path, with_hash=False)
+    if source.get('size') != current['size']:
+        return True
+    if source.get('mtime_ns') == current['mtime_ns']:
+        return False
+    # Same size, different mtime (fresh checkout, touch): compare contents.
+    return source.get('sha256') != _file_sha256(csv_path)
+
+
+def _is_fresh(meta, csv_path):
+    return meta.get('version') == CACHE_VERSION and not changed(csv_path, meta.get('source', {}))
+
+
+def parse_csv(csv_path):
+    return _split(pd.read_csv(csv_path))
+
+
+def _read_source(csv_path):
+    # The file's bytes and their fingerprint, from one read, so rows appended
+    # while they are parsed are in neither.
+    with open(csv_path, 'rb') as f:
+        mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+        data = f.read()
+    return data, dict(size=len(data), mtime_ns=mtime_ns, sha256=hashlib.sha256(data).hexdigest())
+
+
+def _split(df):
+    date_col = None
+    for col in df.columns:
+        if re.search('date', col, re.IGNORECASE):
+            date_col = col
+            df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
+            break
+    dates = df.pop(date_col) if date_col else None
+    return df.to_numpy(dtype=float), list(df.columns), dates, date_col
+
+
+def write_cache(csv_path, values, columns, dates, date_col, source=None):
+    # `source` is the fingerprint of the file contents `values` came from;
+    # taken from the file as it is now by default.
+    values_path, meta_path = cache_paths(csv_path)
+    meta = dict(
+        version=CACHE_VERSION,
+        source=source or _fingerprint(csv_path),
+        shape=list(values.shape),
+        columns=columns,
+        date_col=date_col,
+        dates=None if dates is None else [d.isoformat() if pd.notnull(d) else None for d in dates],
+    )
+    tmp_values = f'{values_path}.{os.getpid()}.tmp'
+    tmp_meta = f'{meta_path}.{os.getpid()}.tmp'
+    with open(tmp_values, 'wb') as f:
+        np.save(f, np.ascontiguousarray(values, dtype=np.float64))
+    with open(tmp_meta, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_values, values_path)
+    os.replace(tmp_meta, meta_path)
+
+
+def read_cache(csv_path, source=None):
+    # The cache if it matches the file, or, given `source`, if it was built
+    # from the contents fingerprinted as `source` whatever the file holds now.
+    values_path, meta_path = cache_paths(csv_path)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if source is not None:
+            if meta.get('version') != CACHE_VERSION or meta.get('source') != source:
+                return None
+        elif not _is_fresh(meta, csv_path):
+            return None
+        values = np.load(values_path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    if list(values.shape) != meta['shape']:
+        return None
+    dates = None
+    if meta['date_col']:
+        dates = pd.Series(pd.to_datetime(meta['dates']), name=meta['date_col'])
+    return values, meta['columns'], dates, meta['date_col']
+
+
+def source_of(csv_path):
+    # Fingerprint of the file the cache was built from, or of the file as it
+    # is now when there is no cache.
+    try:
+        with open(cache_paths(csv_path)[1]) as f:
+            return json.load(f)['source']
+    except (OSError, ValueError, KeyError):
+        return _fingerprint(csv_path)
+
+
+def read_appended(csv_path, source, columns):
+    # Rows appended to the file since it had fingerprint `source`, parsed on
+    # their own: (values, dates, fingerprint of the bytes read), or None if
+    # the file changed in any other way (edited rows, new columns), which
+    # needs a full reload. Only whole rows are read: a row still being
+    # written is left for the next call, and `values` is empty (with the
+    # fingerprint unchanged) until the first new row is complete.
+    with open(csv_path, 'rb') as f:
+        mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+        header = f.readline()
+        h = hashlib.sha256(header)
+        remaining = source['size'] - len(header)
+        last = header[-1:]
+        while remaining > 0:
+            chunk = f.read(min(1 << 20, remaining))
+            if not chunk:
+                return None
+            h.update(chunk)
+            last = chunk[-1:]
+            remaining -= len(chunk)
+        tail = f.read()
+    if h.hexdigest() != source['sha256'] or last != b'\n':
+        return None
+    tail = tail[:tail.rfind(b'\n') + 1]
+    if not tail:
+        return np.empty((0, len(columns))), None, source
+    if not tail.strip():
+        return None
+    h.update(tail)
+    read = dict(size=source['size'] + len(tail), mtime_ns=mtime_ns, sha256=h.hexdigest())
+    names = next(csv.reader([header.decode('utf-8-sig')]))
+    values, tail_columns, dates, _ = _split(pd.read_csv(io.BytesIO(tail), header=None, names=names))
+    if tail_columns != list(columns):
+        return None
+    return values, dates, read
+
+
+def load_csv(csv_path):
+    # Returns (values, columns, dates, date_col). `values` is a read-only
+    # memory map when served from the cache.
+    cached = read_cache(csv_path)
+    if cached is not None:
+        return cached
+    data, source = _read_source(csv_path)
+    parsed = _split(pd.read_csv(io.BytesIO(data)))
+    del data
+    try:
+        write_cache(csv_path, *parsed, source)
+    except OSError:
+        return parsed
+    # Serve the freshly written file too, so every process shares one copy.
+    return read_cache(csv_path, source) or parsed
@@ -0,0 +1,680 @@
+import copy
+import ctypes
+import os
+import re
+import threading
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+import csvcache
+import matching
+import metrics
+import sharedstore
+
+# Loaded once per server process and shared read-only by every session.
+# Sessions must never mutate the objects held by the store; they build their
+# own per-session columns on top of it. In shared mode (see share) the
+# store's arrays are memory-mapped from files every worker process of the
+# server maps, instead of being loaded by each of them.
+
+# AUTO_EXPORTS_DATA_DIR points the app at another data directory with the
+# same file names, e.g. one written by synthdata.py.
+DATA_DIR = os.environ.get('AUTO_EXPORTS_DATA_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+SHAPEFILE_PATH = os.path.join(DATA_DIR, 'ne_10m_admin_0_countries.shp')
+CSV_PATH = os.path.join(DATA_DIR, 'auto_total.csv')
+ALIASES_PATH = os.path.join(DATA_DIR, 'country_aliases.csv')
+MAPPING_PATH = os.path.join(DATA_DIR, 'country_mapping.json')
+
+DEFAULT_TYPE = "Total"
+DEFAULT_VALUE_TYPE = "USD m"
+
+# Map levels of detail, coarsest first: (name, simplification tolerance in
+# degrees, widest visible x-range in degrees at which the level is used).
+# The tolerances roughly match Natural Earth's 110m/50m/10m generalization.
+LEVELS_OF_DETAIL = [
+    ('110m', 0.1, np.inf),
+    ('50m', 0.02, 60.0),
+    ('10m', 0.0, 15.0),
+]
+
+# A country simplified with its neighbours whose area changes by more than
+# this fraction is simplified on its own instead (see _simplify_coverage).
+COVERAGE_AREA_RTOL = 0.2
+
+# Shapefile grouping columns rolled up into regions, with their view names.
+REGION_COLUMNS = {
+    'CONTINENT': 'Continents',
+    'REGION_UN': 'UN regions',
+    'SUBREGION': 'Subregions',
+}
+
+# Data series kept even though no shape matches it.
+WORLD_COUNTRY = 'World'
+
+# Shapefile attributes read by a lean load; every other column is skipped.
+WORLD_COLUMNS = matching.NAME_COLUMNS + list(REGION_COLUMNS)
+
+# The cube is stored as float32 unless a value would not survive the round
+# trip to this relative precision (float32 keeps about 7 digits).
+FLOAT32_RTOL = 1e-6
+
+
+class DataStore:
+    def __init__(self, world, df, dates, date_col, country_type_value_to_col,
+                 export_types, value_types, admin_to_df_map, country_series, source=None, lean=True):
+        # `df` is only read to build the cube and is not kept; the CSV's
+        # column names are, to recognise appended rows.
+        self.world = world
+        self.columns = list(df.columns)
+        # Fingerprint of the CSV contents loaded, and the number of months
+        # carried over from the previous store when rows were appended.
+        self.source = source
+        self.appended_from = None
+        # Shared store generation this store was attached from, and the one
+        # it was derived from (see sharedstore.py); None for a private store.
+        self.generation = None
+        self.previous_generation = None
+        self.date_col = date_col
+        self.country_type_value_to_col = country_type_value_to_col
+        self.export_types = export_types
+        self.value_types = value_types
+        # Raw value types (cube axis) followed by the derived metrics.
+        self.value_type_options = value_types + list(metrics.DERIVED)
+        # ADMIN -> cube country, and cube country -> the df series merged
+        # into it (period splits and alternate spellings).
+        self.admin_to_df_map = admin_to_df_map
+        self.country_series = country_series
+        self.dates = dates if dates is not None else pd.Series(df.index)
+        self.countries = list(country_series.keys())
+        self.cube = _build_cube(df, country_type_value_to_col, country_series, export_types, value_types)
+        if lean:
+            self.cube = _downcast(self.cube)
+        self._country_index = {c: i for i, c in enumerate(self.countries)}
+        self._type_index = {t: i for i, t in enumerate(export_types)}
+        self._value_type_index = {v: i for i, v in enumerate(value_types)}
+        self._reset_caches()
+        # Cube country position for every row of `world`; -1 points at the
+        # all-NaN padding slot so unmatched shapes need no special casing.
+        self.world_rows = np.array(
+            [self._country_index.get(admin_to_df_map.get(a), -1) for a in world['ADMIN']],
+            dtype=np.intp,
+        )
+        # Map polygons in the NaN-separated layout p.patches expects, one
+        # (xs, ys) pair per level of detail; shared by every session. Clients
+        # start on the coarsest level and fetch finer rows as they zoom in.
+        self.bounds = shapely.bounds(world.geometry.values)
+        levels = [_simplify_coverage(world.geometry.values, tolerance) for _, tolerance, _ in LEVELS_OF_DETAIL]
+        self.lod_xs, self.lod_ys = [], []
+        for geometry in levels:
+            xs, ys = _patch_coords(geometry)
+            self.lod_xs.append(xs)
+            self.lod_ys.append(ys)
+        # Region rollups per grouping column, drawn on the coarsest level.
+        self.rollups = {
+            column: RegionRollup(self, world[column], levels[0])
+            for column in REGION_COLUMNS if column in world.columns
+        }
+
+    def extended(self, df, dates, source):
+        # A new store with the months in `df` appended; `dates` covers all
+        # months. Only the new months go into the cube and the region
+        # rollups; geometry and country matching are reused, and the
+        # memoized frames, rankings and metrics rebuild lazily.
+        store = copy.copy(self)
+        new_rows = _build_cube(df, self.country_type_value_to_col, self.country_series,
+                               self.export_types, self.value_types).astype(self.cube.dtype)
+        n_months = len(self.dates) + len(df)
+        store.dates = dates if dates is not None else pd.Series(range(n_months))
+        store.source = source
+        store.appended_from = len(self.dates)
+        store.generation, store.previous_generation = None, self.generation
+        store.cube = np.concatenate([self.cube, new_rows])
+        store._reset_caches()
+        store.rollups = {column: rollup.extended(store, new_rows) for column, rollup in self.rollups.items()}
+        return store
+
+    def _reset_caches(self):
+        # Per-process memoized metrics, frames and rankings.
+        self.metrics = metrics.MetricCache(self._raw_block)
+        self._frames = {}
+        self._rankings = {}
+        self._frames_lock = threading.Lock()
+
+    def __getstate__(self):
+        # What sharedstore writes: polygons packed into flat coordinate
+        # arrays, `world` without the geometry, which is only needed to
+        # build the store, and no per-process caches.
+        state = self.__dict__.copy()
+        for key in ('metrics', '_frames', '_rankings', '_frames_lock'):
+            del state[key]
+        state['world'] = pd.DataFrame(self.world.drop(columns='geometry', errors='ignore'))
+        state['lod_xs'] = [_pack(xs) for xs in self.lod_xs]
+        state['lod_ys'] = [_pack(ys) for ys in self.lod_ys]
+        return state
+
+    def __setstate__(self, state):
+        state['lod_xs'] = [_unpack(*packed) for packed in state['lod_xs']]
+        state['lod_ys'] = [_unpack(*packed) for packed in state['lod_ys']]
+        self.__dict__.update(state)
+        self._reset_caches()
+
+    def frames(self, exp_type, value_type, n_colors, grouping=None):
+        # Map state for every (month, shapefile row), or every region of a
+        # rollup, built once per process for each (export type, value type)
+        # and shared by all sessions.
+        key = (exp_type, value_type, n_colors, grouping)
+        with self._frames_lock:
+            if key not in self._frames:
+                if grouping is None:
+                    values = self.block(exp_type, value_type)[:, self.world_rows]
+                else:
+                    values = self.rollups[grouping].block(exp_type, value_type)
+                self._frames[key] = MapFrames(values, metrics.is_usd(value_type), n_colors)
+            return self._frames[key]
+
+    def rankings(self, exp_type, value_type, window=1):
+        # Rank order of every shapefile row in every month, by the month's
+        # value or by a trailing `window`-month aggregate; built once per
+        # process for each key and shared by all sessions.
+        key = (exp_type, value_type, window)
+        with self._frames_lock:
+            if key not in self._rankings:
+                values = metrics.trailing(self.block(exp_type, value_type), window, mean=not metrics.is_usd(value_type))
+                self._rankings[key] = Rankings(values[:, self.world_rows], window)
+            return self._rankings[key]
+
+    def level_of_detail(self, x_span):
+        # Finest level whose x-range threshold the visible span fits in.
+        level = 0
+        for i, (_, _, max_span) in enumerate(LEVELS_OF_DETAIL):
+            if x_span <= max_span:
+                level = i
+        return level
+
+    def rows_in_view(self, x0, x1, y0, y1):
+        b = self.bounds
+        return np.flatnonzero((b[:, 2] >= min(x0, x1)) & (b[:, 0] <= max(x0, x1)) &
+                              (b[:, 3] >= min(y0, y1)) & (b[:, 1] <= max(y0, y1)))
+
+    def country_index(self, country):
+        return self._country_index.get(country, -1)
+
+    def block(self, exp_type, value_type):
+        # (date x country) values of a raw or derived value type. Raw ones
+        # are views of the cube; derived ones come from the metric cache.
+        # Neither may be modified.
+        if value_type in metrics.DERIVED and exp_type in self._type_index:
+            return self.metrics.get(value_type, exp_type)
+        return self._raw_block(exp_type, value_type)
+
+    def _raw_block(self, exp_type, value_type):
+        e = self._type_index.get(exp_type)
+        v = self._value_type_index.get(value_type)
+        if e is None or v is None:
+            return np.full(self.cube.shape[:2], np.nan)
+        return self.cube[:, :, e, v]
+
+    def series(self, country, exp_type, value_type):
+        # Full monthly series for one cube country (a df series name).
+        return self.block(exp_type, value_type)[:, self.country_index(country)]
+
+
+class RegionRollup:
+    # Country cube summed over the regions of one shapefile grouping column,
+    # for every month, export type and value type in one pass, plus the
+    # dissolved region outlines. A cube country counts once per region even
+    # if several shapefile rows map to it; a region cell is NaN only if all
+    # of its countries are. Derived metrics are computed from the region
+    # sums, not summed per country.
+    def __init__(self, store, labels, geometry):
+        labels = labels.fillna('').astype(str).to_numpy()
+        self.names = sorted(set(labels) - {''})
+        self._store = store
+        self._region_index = {r: i for i, r in enumerate(self.names)}
+        region = np.array([self._region_index.get(label, -1) for label in labels], dtype=np.intp)
+        member = (store.world_rows >= 0) & (region >= 0)
+        self._membership = np.zeros((store.cube.shape[1], len(self.names)), dtype=store.cube.dtype)
+        self._membership[store.world_rows[member], region[member]] = 1
+        self.cube = self._sum(store.cube)
+        self.metrics = metrics.MetricCache(self._raw_block)
+        outlines = [shapely.union_all(geometry[region == i]) for i in range(len(self.names))]
+        self.xs, self.ys = _patch_coords(outlines)
+
+    def _sum(self, cube):
+        total = np.einsum('tcev,cg->tgev', np.nan_to_num(cube), self._membership)
+        counts = np.einsum('tcev,cg->tgev', (~np.isnan(cube)).astype(cube.dtype), self._membership)
+        return np.where(counts > 0, total, np.nan)
+
+    def extended(self, store, new_rows):
+        # Rollup of `store`, whose cube is this one's plus `new_rows` months.
+        rollup = copy.copy(self)
+        rollup._store = store
+        rollup.cube = np.concatenate([self.cube, self._sum(new_rows)])
+        rollup.metrics = metrics.MetricCache(rollup._raw_block)
+        return rollup
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['metrics']
+        state['xs'], state['ys'] = _pack(self.xs), _pack(self.ys)
+        return state
+
+    def __setstate__(self, state):
+        state['xs'], state['ys'] = _unpack(*state['xs']), _unpack(*state['ys'])
+        self.__dict__.update(state)
+        self.metrics = metrics.MetricCache(self._raw_block)
+
+    def region_index(self, region):
+        return self._region_index.get(region, -1)
+
+    def block(self, exp_type, value_type):
+        # (date x region) values, as DataStore.block.
+        if value_type in metrics.DERIVED and exp_type in self._store._type_index:
+            return self.metrics.get(value_type, exp_type)
+        return self._raw_block(exp_type, value_type)
+
+    def _raw_block(self, exp_type, value_type):
+        e = self._store._type_index.get(exp_type)
+        v = self._store._value_type_index.get(value_type)
+        if e is None or v is None:
+            return np.full(self.cube.shape[:2], np.nan)
+        return self.cube[:, :, e, v]
+
+    def series(self, region, exp_type, value_type):
+        i = self.region_index(region)
+        if i < 0:
+            return np.full(self.cube.shape[0], np.nan)
+        return self.block(exp_type, value_type)[:, i]
+
+
+class MapFrames:
+    # Values, color-scale values and palette indices for every month at once.
+    # USD values are colored on a log1p scale (non-positive values get no
+    # color), shares on a linear one; each month is normalized to its own
+    # min/max. color_idx is NO_COLOR where a row has no color.
+    NO_COLOR = 255
+
+    def __init__(self, values, log_scale, n_colors):
+        self.values = values
+        # What sessions send to the client; the same array for a float32 cube.
+        self.values32 = values.astype(np.float32, copy=False)
+        self.log_scale = log_scale
+        with np.errstate(invalid='ignore'):
+            self.plot = np.where(values > 0, np.log1p(np.where(values > 0, values, 0)), np.nan) if log_scale else values
+        self.low = np.fmin.reduce(self.plot, axis=1)
+        self.high = np.fmax.reduce(self.plot, axis=1)
+        span = (self.high - self.low)[:, None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            norm = np.where(span != 0, (self.plot - self.low[:, None]) / span, 0.0)
+        idx = np.round(np.clip(norm, 0, 1) * (n_colors - 1))
+        self.color_idx = np.where(np.isnan(self.plot), self.NO_COLOR, np.nan_to_num(idx)).astype(np.uint8)
+
+
+class Rankings:
+    # Stable descending order of the rows of every month, from one argsort
+    # over the whole history. Ties keep row order; NaN rows sort last and get
+    # rank -1. Top-N lookups are plain slices of `order`.
+    def __init__(self, values, window):
+        self.values = values
+        self.window = window
+        self.order = np.argsort(-values, axis=1, kind='stable')
+        self.counts = np.count_nonzero(~np.isnan(values), axis=1)
+        self.ranks = np.empty_like(self.order)
+        np.put_along_axis(self.ranks, self.order, np.broadcast_to(np.arange(values.shape[1]), values.shape), axis=1)
+        self.ranks[np.isnan(values)] = -1
+
+    def top(self, t, n):
+        # Rows of the n highest values in month t, best first.
+        return self.order[t, :min(n, self.counts[t])]
+
+    def rank_change(self, t, rows):
+        # Places gained since the prior period (t - window); NaN where either
+        # period has no rank.
+        change = np.full(len(rows), np.nan)
+        prior = t - self.window
+        if prior >= 0:
+            before, now = self.ranks[prior, rows], self.ranks[t, rows]
+            ranked = (before >= 0) & (now >= 0)
+            change[ranked] = (before - now)[ranked]
+        return change
+
+
+# --- DATA LOAD ---
+def _read_csv(path):
+    # Numeric columns as a DataFrame over the (memory-mapped) cached matrix,
+    # plus the parsed date index kept separately.
+    values, columns, dates, date_col = csvcache.load_csv(path)
+    return pd.DataFrame(values, columns=columns, copy=False), dates, date_col
+
+
+def _append_csv(store, path):
+    # DataFrame of the rows appended to the CSV since the store was loaded,
+    # the dates of all months and the fingerprint of what was read; None
+    # when the file changed in any other way, or the cache of the loaded
+    # rows is gone. The DataFrame is empty while the first new row is still
+    # being written. The cache is rewritten to cover the new rows.
+    appended = csvcache.read_appended(path, store.source, store.columns)
+    if appended is None:
+        return None
+    values, dates, source = appended
+    if not len(values):
+        return pd.DataFrame(values, columns=store.columns), None, source
+    loaded = csvcache.read_cache(path, store.source)
+    if loaded is None:
+        return None
+    if store.date_col:
+        dates = pd.concat([store.dates, dates], ignore_index=True)
+    try:
+        csvcache.write_cache(path, np.concatenate([loaded[0], values]), store.columns, dates, store.date_col, source)
+    except OSError:
+        pass
+    return pd.DataFrame(values, columns=store.columns, copy=False), dates if store.date_col else None, source
+
+
+# --- COUNTRY COLUMN MAP ---
+def _parse_columns(columns):
+    country_type_value_to_col = {}
+    export_types = set()
+    value_types = set()
+    for col in columns:
+        m1 = re.match(r'Exports, Autos, (\w+), (.*?), USD m', col)
+        m2 = re.match(r'Exports, Autos, (\w+), (.*?), % of total', col)
+        if m1:
+            exp_type = m1.group(1)
+            country = m1.group(2)
+            export_types.add(exp_type)
+            value_types.add('USD m')
+            country_type_value_to_col.setdefault(country, {}).setdefault(exp_type, {})['USD m'] = col
+        elif m2:
+            exp_type = m2.group(1)
+            country = m2.group(2)
+            export_types.add(exp_type)
+            value_types.add('% of total')
+            country_type_value_to_col.setdefault(country, {}).setdefault(exp_type, {})['% of total'] = col
+
+    export_types = sorted(list(export_types))
+    value_types = sorted(list(value_types))
+    if DEFAULT_TYPE not in export_types:
+        export_types.insert(0, DEFAULT_TYPE)
+    if DEFAULT_VALUE_TYPE not in value_types:
+        value_types.insert(0, DEFAULT_VALUE_TYPE)
+    return country_type_value_to_col, export_types, value_types
+
+
+# --- DATA CUBE ---
+def _build_cube(df, country_type_value_to_col, country_series, export_types, value_types):
+    # Dense (date x country x export type x value type) array. Series merged
+    # into one country are summed (they do not overlap in time); a cell is
+    # NaN only if all of them are. The country axis has one extra all-NaN
+    # slot at the end for unmatched lookups.
+    shape = (len(df), len(country_series) + 1, len(export_types), len(value_types))
+    type_index = {t: i for i, t in enumerate(export_types)}
+    value_type_index = {v: i for i, v in enumerate(value_types)}
+    ci, ei, vi, cols = [], [], [], []
+    for c, country in enumerate(country_series):
+        for series in country_series[country]:
+            for exp_type, by_value in country_type_value_to_col[series].items():
+                for value_type, col in by_value.items():
+                    ci.append(c)
+                    ei.append(type_index[exp_type])
+                    vi.append(value_type_index[value_type])
+                    cols.append(col)
+    total = np.zeros(shape)
+    counts = np.zeros(shape, dtype=np.int32)
+    if cols:
+        values = df[cols].to_numpy(dtype=float)
+        index = (slice(None), np.array(ci), np.array(ei), np.array(vi))
+        np.add.at(total, index, np.nan_to_num(values))
+        np.add.at(counts, index, ~np.isnan(values))
+    return np.where(counts > 0, total, np.nan)
+
+
+def _downcast(cube):
+    # float32 copy of the cube, if every value fits it to FLOAT32_RTOL.
+    narrow = cube.astype(np.float32)
+    with np.errstate(invalid='ignore', over='ignore'):
+        exact = np.allclose(narrow, cube, rtol=FLOAT32_RTOL, atol=0, equal_nan=True)
+    return narrow if exact else cube
+
+
+# --- MAP GEOMETRY ---
+def _patch_coords(geometry):
+    # Exterior rings only, parts of a MultiPolygon separated by NaN, matching
+    # what GeoJSONDataSource produces on the client.
+    gap = np.array([[np.nan, np.nan]])
+    xs, ys = [], []
+    for geom in geometry:
+        if geom is None or geom.is_empty:
+            xs.append(np.array([]))
+            ys.append(np.array([]))
+            continue
+        parts = geom.geoms if geom.geom_type == 'MultiPolygon' else [geom]
+        rings = []
+        for part in parts:
+            if rings:
+                rings.append(gap)
+            rings.append(np.asarray(part.exterior.coords)[:, :2])
+        coords = np.concatenate(rings)
+        xs.append(np.ascontiguousarray(coords[:, 0]))
+        ys.append(np.ascontiguousarray(coords[:, 1]))
+    return xs, ys
+
+
+def _pack(arrays):
+    # One flat array plus offsets for a list of coordinate arrays.
+    offsets = np.cumsum([0] + [len(a) for a in arrays], dtype=np.int64)
+    flat = np.concatenate(arrays) if arrays else np.array([])
+    return flat, offsets
+
+
+def _unpack(flat, offsets):
+    # The list of arrays again, as views of `flat`.
+    return [flat[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+def _simplify_coverage(geoms, tolerance):
+    # Simplify shared borders once instead of per country, so neighbours stay
+    # edge-to-edge: node all boundaries into arcs between junctions, simplify
+    # each arc, node the simplified arcs again where they now cross or
+    # overlap, rebuild faces and hand each face back to the country it lies
+    # in. Countries that lose every face (tiny islands) or whose area moves
+    # by more than COVERAGE_AREA_RTOL fall back to a per-geometry
+    # simplification, and so does every country if the arcs leave cut edges
+    # or dangles.
+    if tolerance <= 0:
+        return geoms
+    simplified = shapely.simplify(geoms, tolerance, preserve_topology=True)
+    arcs = shapely.get_parts(shapely.line_merge(shapely.union_all(shapely.boundary(geoms))))
+    noded = shapely.get_parts(shapely.union_all(shapely.simplify(arcs, tolerance)))
+    faces, cuts, dangles, invalid = shapely.polygonize_full(noded)
+    if not (shapely.is_empty(cuts) and shapely.is_empty(dangles) and shapely.is_empty(invalid)):
+        return simplified
+    faces = shapely.get_parts(faces)
+    face_idx, geom_idx = shapely.STRtree(geoms).query(shapely.point_on_surface(faces), predicate='intersects')
+    face_idx, first = np.unique(face_idx, return_index=True)
+    geom_idx = geom_idx[first]
+
+    order = np.argsort(geom_idx, kind='stable')
+    owners, starts = np.unique(geom_idx[order], return_index=True)
+    for owner, owned in zip(owners, np.split(faces[face_idx[order]], starts[1:])):
+        merged = shapely.multipolygons(owned) if len(owned) > 1 else owned[0]
+        area = shapely.area(geoms[owner])
+        if abs(shapely.area(merged) - area) <= COVERAGE_AREA_RTOL * area:
+            simplified[owner] = merged
+    return simplified
+
+
+# --- COUNTRY MATCHING ---
+def _match_countries(world, country_list, prune=True):
+    # Matched shapes (plus China, the exporter) with only the columns the app
+    # uses, taken in one selection. With `prune`, series matching no shape
+    # are dropped, except the world total.
+    admin_to_df_map, country_series = matching.load_mapping(country_list, world, MAPPING_PATH, ALIASES_PATH)
+    rows = np.flatnonzero(world['ADMIN'].isin(admin_to_df_map.keys()))
+    if not (world['ADMIN'].to_numpy()[rows] == "China").any():
+        rows = np.append(rows, np.flatnonzero(world['ADMIN'] == "China"))
+    keep = ['ADMIN'] + [c for c in REGION_COLUMNS if c in world.columns] + ['geometry']
+    filtered_world = world.iloc[rows, [world.columns.get_loc(c) for c in keep]]
+    filtered_world.index = pd.RangeIndex(len(rows))
+    if prune:
+        used = set(admin_to_df_map.values()) | {WORLD_COUNTRY}
+        country_series = {country: series for country, series in country_series.items() if country in used}
+    return filtered_world, admin_to_df_map, country_series
+
+
+def load(shapefile_path=SHAPEFILE_PATH, csv_path=CSV_PATH, lean=True):
+    # A lean load reads only the shapefile columns in WORLD_COLUMNS, drops
+    # series that never reach the map, keeps the cube as float32 when that
+    # is precise enough and trims the heap afterwards. lean=False loads the
+    # way it used to, for comparison (see memreport.py).
+    world = gpd.read_file(shapefile_path, include_fields=WORLD_COLUMNS) if lean else gpd.read_file(shapefile_path)
+    df, dates, date_col = _read_csv(csv_path)
+    source = csvcache.source_of(csv_path)
+    country_type_value_to_col, export_types, value_types = _parse_columns(df.columns)
+    filtered_world, admin_to_df_map, country_series = _match_countries(
+        world, list(country_type_value_to_col.keys()), prune=lean)
+    store = DataStore(filtered_world, df, dates, date_col, country_type_value_to_col,
+                      export_types, value_types, admin_to_df_map, country_series, source, lean)
+    del world, df
+    if lean:
+        _trim_heap()
+    return store
+
+
+def _trim_heap():
+    # Building the geometry allocates a lot of short-lived memory; return the
+    # freed heap to the OS so a worker's resident memory is what the store
+    # holds. Only glibc has malloc_trim.
+    try:
+        ctypes.CDLL(None).malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+_store = None
+_store_lock = threading.Lock()
+_listeners = []
+
+# Directory of the shared store, set by serve.py for --num-procs or through
+# AUTO_EXPORTS_SHARED_DIR; None loads a private store per process.
+_shared_dir = os.environ.get('AUTO_EXPORTS_SHARED_DIR') or None
+
+
+def share(directory):
+    # Switch this process, and the workers it forks, to the shared store in
+    # `directory`. Must be called before the first get_store.
+    global _shared_dir
+    _shared_dir = directory
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = _attach_or_load() if _shared_dir else load()
+    return _store
+
+
+def _attach_or_load():
+    # The published shared store if it was built from the CSV as it is now;
+    # otherwise the first process to get the build lock loads and publishes
+    # one while the others wait, then attach to it.
+    store = sharedstore.attach(_shared_dir)
+    if store is None or csvcache.changed(CSV_PATH, store.source):
+        with sharedstore.build_lock(_shared_dir):
+            store = sharedstore.attach(_shared_dir)
+            if store is None or csvcache.changed(CSV_PATH, store.source):
+                publish(load)
+                store = sharedstore.attach(_shared_dir)
+    return store
+
+
+def publish(build):
+    # Publish the store `build()` returns, if any, as the new shared
+    # generation, then free this private copy of it; the process attaches
+    # like any other.
+    store = build()
+    if store is None:
+        return
+    sharedstore.publish(_shared_dir, store)
+    del store
+    _trim_heap()
+
+
+# --- RELOAD ---
+# Stores are never modified once published; a reload builds a new one and
+# replaces the current store in a single assignment. Sessions keep using the
+# store they have until they switch in their own document callback, so
+# none of them sees a half-applied update.
+#
+# With a shared store, the worker that gets the build lock builds the new
+# store and publishes it as a new generation; every worker, that one
+# included, then attaches to it on its next check. Publishing replaces the
+# generation pointer in one rename, so all workers switch to the same
+# complete store.
+def subscribe(listener):
+    # `listener(store)` is called, from the reloading thread, with every new
+    # store.
+    _listeners.append(listener)
+
+
+def unsubscribe(listener):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def reload(csv_path=CSV_PATH):
+    # Picks up changes to the CSV: appended months extend the current store,
+    # any other change loads everything again. Returns the new store, or
+    # None if nothing changed.
+    global _store
+    with _store_lock:
+        store = _store
+        if store is None:
+            return None
+        if _shared_dir:
+            store = _reload_shared(store, csv_path)
+        elif store.source is None or not csvcache.changed(csv_path, store.source):
+            return None
+        else:
+            store = _rebuilt(store, csv_path)
+        if store is None:
+            return None
+        _store = store
+    for listener in list(_listeners):
+        listener(store)
+    return store
+
+
+def _rebuilt(store, csv_path):
+    # None while the rows being appended are incomplete; the next check
+    # tries again.
+    appended = _append_csv(store, csv_path)
+    if appended is None:
+        return load(csv_path=csv_path)
+    if appended[0].empty:
+        return None
+    return store.extended(*appended)
+
+
+def _reload_shared(store, csv_path):
+    # The newly published shared store, if there is one, after building and
+    # publishing it here when the CSV changed and no other worker is at it.
+    with sharedstore.build_lock(_shared_dir, blocking=False) as locked:
+        if (locked and sharedstore.current(_shared_dir) == store.generation
+                and store.source is not None and csvcache.changed(csv_path, store.source)):
+            publish(lambda: _rebuilt(store, csv_path))
+    if sharedstore.current(_shared_dir) in (None, store.generation):
+        return None
+    new = sharedstore.attach(_shared_dir)
+    if new is None or new.generation == store.generation:
+        return None
+    if new.previous_generation != store.generation:
+        # Months were appended to a generation this worker never attached
+        # to: its sessions need the full refresh.
+        new.appended_from = None
+    return new
@@ -0,0 +1,184 @@
+import csv
+import io
+import re
+
+import numpy as np
+from tornado.iostream import StreamClosedError
+from tornado.web import HTTPError, RequestHandler
+
+import datastore
+
+# Streaming export of arbitrary slices of the store, served next to the
+# Bokeh app (see serve.py):
+#
+#   GET /export?country=Germany&country=France&type=Electric
+#              &value_type=USD m&start=2022-01&end=2023-06&format=csv
+#
+# `country`, `type` and `value_type` may be repeated and default to
+# everything; `start` and `end` are inclusive YYYY[-MM[-DD]] prefixes. Rows
+# are produced by a generator and written in chunks, so a full export never
+# sits in memory. `format=parquet` needs pyarrow and writes one row group
+# per chunk.
+
+EXPORT_PATH = '/export'
+CHUNK_ROWS = 5000
+COLUMNS = ['date', 'country', 'export_type', 'value_type', 'value']
+DATE_PREFIX = re.compile(r'\d{4}(-\d{2}(-\d{2})?)?$')
+
+
+def date_labels(store):
+    if store.date_col:
+        return np.array(store.dates.dt.strftime('%Y-%m-%d').tolist(), dtype=object)
+    return np.array([str(d) for d in store.dates], dtype=object)
+
+
+def export_rows(store, countries, export_types, value_types, rows):
+    # (date, country, export type, value type, value) for every requested
+    # series, one series at a time. `countries` holds (label, cube country)
+    # pairs; `rows` selects the months.
+    dates = date_labels(store)[rows]
+    for label, country in countries:
+        for exp_type in export_types:
+            for value_type in value_types:
+                values = store.series(country, exp_type, value_type)[rows]
+                if values.dtype == np.float32:
+                    # Shortest decimals that read back as the stored float32,
+                    # rather than its float64 expansion.
+                    values = values.astype(str).astype(float)
+                for date, value in zip(dates, values.tolist()):
+                    yield date, label, exp_type, value_type, None if value != value else value
+
+
+def chunks(rows, size=CHUNK_ROWS):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class _Sink(io.RawIOBase):
+    # Append-only byte sink that hands out what was written so far. Keeps
+    # counting positions across drains, since the Parquet footer records
+    # absolute offsets.
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ExportHandler(RequestHandler):
+    def _countries(self, store):
+        names = self.get_arguments('country')
+        if not names:
+            return [(admin, store.admin_to_df_map[admin]) for admin in sorted(store.admin_to_df_map)]
+        countries = []
+        for name in names:
+            # Map (ADMIN) names, or the data's own series names such as "World".
+            country = store.admin_to_df_map.get(name, name)
+            if store.country_index(country) < 0:
+                raise HTTPError(400, reason=f"Unknown country: {name}")
+            countries.append((name, country))
+        return countries
+
+    def _choices(self, name, options):
+        values = self.get_arguments(name) or list(options)
+        for value in values:
+            if value not in options:
+                raise HTTPError(400, reason=f"Unknown {name}: {value}")
+        return values
+
+    def _rows(self, store):
+        dates = date_labels(store)
+        start = self.get_argument('start', '')
+        end = self.get_argument('end', '')
+        for bound in (start, end):
+            if bound and not DATE_PREFIX.match(bound):
+                raise HTTPError(400, reason=f"Bad date: {bound}")
+        mask = np.ones(len(dates), dtype=bool)
+        if start:
+            mask &= np.array([d[:len(start)] >= start for d in dates], dtype=bool)
+        if end:
+            mask &= np.array([d[:len(end)] <= end for d in dates], dtype=bool)
+        return np.flatnonzero(mask)
+
+    async def get(self):
+        store = datastore.get_store()
+        fmt = self.get_argument('format', 'csv')
+        if fmt not in ('csv', 'parquet'):
+            raise HTTPError(400, reason=f"Unknown format: {fmt}")
+        rows = export_rows(
+            store,
+            self._countries(store),
+            self._choices('type', store.export_types),
+            self._choices('value_type', store.value_type_options),
+            self._rows(store),
+        )
+        try:
+            if fmt == 'csv':
+                await self._write_csv(rows)
+            else:
+                await self._write_parquet(rows)
+        except StreamClosedError:
+            # The client went away mid-download; stop generating rows.
+            pass
+
+    async def _write_csv(self, rows):
+        self.set_header('Content-Type', 'text/csv; charset=utf-8')
+        self.set_header('Content-Disposition', 'attachment; filename="auto_exports.csv"')
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(COLUMNS)
+        for chunk in chunks(rows):
+            writer.writerows(chunk)
+            self.write(buf.getvalue())
+            buf.seek(0)
+            buf.truncate()
+            await self.flush()
+        if buf.tell():
+            self.write(buf.getvalue())
+        self.finish()
+
+    async def _write_parquet(self, rows):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise HTTPError(501, reason="Parquet export requires pyarrow")
+        schema = pa.schema([
+            ('date', pa.string()), ('country', pa.string()), ('export_type', pa.string()),
+            ('value_type', pa.string()), ('value', pa.float64()),
+        ])
+        self.set_header('Content-Type', 'application/vnd.apache.parquet')
+        self.set_header('Content-Disposition', 'attachment; filename="auto_exports.parquet"')
+        # The writer only appends, so each row group can be sent as soon as
+        # it is written; the footer goes out on close.
+        sink = _Sink()
+        writer = pq.ParquetWriter(sink, schema)
+        try:
+            for chunk in chunks(rows):
+                writer.write_table(pa.Table.from_pylist([dict(zip(COLUMNS, row)) for row in chunk], schema=schema))
+                self.write(sink.drain())
+                await self.flush()
+        finally:
+            writer.close()
+        self.write(sink.drain())
+        self.finish()
@@ -0,0 +1,272 @@
+import contextlib
+import functools
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from bokeh.document.events import DocumentPatchedEvent
+from bokeh.protocol import Protocol
+from tornado.web import RequestHandler
+
+log = logging.getLogger(__name__)
+
+# Per-process runtime metrics, off unless enabled:
+#
+#   python app/serve.py --metrics [--metrics-log-interval 60]
+#   AUTO_EXPORTS_METRICS=1 AUTO_EXPORTS_METRICS_LOG_S=60 bokeh serve app
+#
+# Recorded: time spent in every widget event handler of a session, the
+# compute and apply time of every scheduled update and its latency from the
+# first request to the applied result, the PATCH-DOC bytes each combined
+# document update sends, active and created sessions with the time to build
+# their document, and the process's memory and CPU time. serve.py exposes
+# them at /metrics in the Prometheus text format; with a log interval they
+# are also summarised in one log line per interval.
+#
+# When disabled, handlers are registered unwrapped and the scheduler skips
+# all measuring, so what remains is a flag check and a timestamp per
+# update. Each worker process of --num-procs keeps and serves its own
+# numbers, told apart by the `pid` of auto_exports_worker_info.
+
+METRICS_PATH = '/metrics'
+PREFIX = 'auto_exports'
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = (1e3, 4e3, 16e3, 64e3, 256e3, 1e6, 4e6, 16e6)
+
+enabled = os.environ.get('AUTO_EXPORTS_METRICS', '') not in ('', '0')
+log_interval_s = float(os.environ.get('AUTO_EXPORTS_METRICS_LOG_S') or 0)
+
+
+def configure(enable=None, log_interval=None):
+    # Called before the first session is created (see serve.py).
+    global enabled, log_interval_s
+    if enable is not None:
+        enabled = enable
+    if log_interval is not None:
+        log_interval_s = log_interval
+        enabled = enabled or log_interval > 0
+
+
+class Histogram:
+    # Cumulative bucket counts, sum and count, as Prometheus expects them.
+    # Observed from the document threads and the update worker pool.
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def lines(self, name, labels):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for bound, n in zip(list(self.buckets) + ['+Inf'], counts):
+            cumulative += n
+            yield f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}'
+        yield f'{name}_sum{format_labels(labels)} {total}'
+        yield f'{name}_count{format_labels(labels)} {count}'
+
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    quoted = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, quoted)) + '}'
+
+
+# --- RECORDED METRICS ---
+
+handler_seconds = defaultdict(lambda: Histogram(SECONDS_BUCKETS))   # handler -> histogram
+update_seconds = defaultdict(lambda: Histogram(SECONDS_BUCKETS))    # (update, phase) -> histogram
+update_errors = defaultdict(int)                                    # update -> count
+patch_bytes = Histogram(BYTES_BUCKETS)
+session_create_seconds = Histogram(SECONDS_BUCKETS)
+sessions = dict(active=0, created=0)
+
+
+def timed_handler(label, handler):
+    # `handler` itself when disabled, otherwise a wrapper timing each call.
+    if not enabled:
+        return handler
+    histogram = handler_seconds[label]
+
+    # Keeps the handler's signature, which Bokeh checks on registration.
+    @functools.wraps(handler)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return timed
+
+
+def timed_compute(name, compute):
+    histogram = update_seconds[name, 'compute']
+
+    def timed(*args):
+        start = time.perf_counter()
+        try:
+            return compute(*args)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return timed
+
+
+def observe_update(name, phase, seconds):
+    update_seconds[name, phase].observe(seconds)
+
+
+def count_error(name):
+    update_errors[name] += 1
+
+
+def message_bytes(msg):
+    return (len(msg.header_json) + len(msg.metadata_json) + len(msg.content_json)
+            + sum(len(buffer.to_bytes()) for buffer in msg.buffers))
+
+
+def observe_patch(events):
+    # What the server sends for one combined document update; other events
+    # (e.g. callbacks added) stay on the server.
+    events = [event for event in events if isinstance(event, DocumentPatchedEvent)]
+    if events:
+        patch_bytes.observe(message_bytes(Protocol().create('PATCH-DOC', events)))
+
+
+@contextlib.contextmanager
+def recording(doc):
+    # Records the changes made to `doc` inside the block as one document
+    # update. Enclose the document hold, whose events are delivered on unhold.
+    if not enabled:
+        yield
+        return
+    events = []
+    doc.on_change(events.append)
+    try:
+        yield
+    finally:
+        doc.remove_on_change(events.append)
+        observe_patch(events)
+
+
+def session_created(doc, seconds):
+    # `seconds` to build the document of a new session.
+    if not enabled:
+        return
+    session_create_seconds.observe(seconds)
+    sessions['active'] += 1
+    sessions['created'] += 1
+    doc.on_session_destroyed(session_destroyed)
+
+
+def session_destroyed(session_context):
+    sessions['active'] -= 1
+
+
+def rss_bytes():
+    # Current resident set size, or None where /proc is not available.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def cpu_seconds():
+    times = os.times()
+    return times.user + times.system
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+# --- EXPOSITION ---
+
+def render():
+    # All metrics in the Prometheus text format, version 0.0.4.
+    out = []
+
+    def metric(name, kind, help_text, lines):
+        out.append(f'# HELP {name} {help_text}')
+        out.append(f'# TYPE {name} {kind}')
+        out.extend(lines)
+
+    metric(f'{PREFIX}_worker_info', 'gauge', "Worker process serving this scrape.",
+           [f'{PREFIX}_worker_info{format_labels([("pid", os.getpid())])} 1'])
+    metric(f'{PREFIX}_handler_seconds', 'histogram', "Time in widget event handlers.",
+           [line for label, h in sorted(handler_seconds.items())
+            for line in h.lines(f'{PREFIX}_handler_seconds', [('handler', label)])])
+    metric(f'{PREFIX}_update_seconds', 'histogram',
+           "Scheduled update time by phase: compute (worker pool), apply (document), total (request to applied).",
+           [line for (name, phase), h in sorted(update_seconds.items())
+            for line in h.lines(f'{PREFIX}_update_seconds', [('update', name), ('phase', phase)])])
+    metric(f'{PREFIX}_update_errors_total', 'counter', "Scheduled updates that raised.",
+           [f'{PREFIX}_update_errors_total{format_labels([("update", name)])} {n}'
+            for name, n in sorted(update_errors.items())])
+    metric(f'{PREFIX}_document_update_bytes', 'histogram', "PATCH-DOC bytes per combined document update.",
+           list(patch_bytes.lines(f'{PREFIX}_document_update_bytes', [])))
+    metric(f'{PREFIX}_sessions', 'gauge', "Open sessions.", [f"{PREFIX}_sessions {sessions['active']}"])
+    metric(f'{PREFIX}_sessions_created_total', 'counter', "Sessions created.",
+           [f"{PREFIX}_sessions_created_total {sessions['created']}"])
+    metric(f'{PREFIX}_session_create_seconds', 'histogram', "Time to build a new session's document.",
+           list(session_create_seconds.lines(f'{PREFIX}_session_create_seconds', [])))
+    rss = rss_bytes()
+    if rss is not None:
+        metric('process_resident_memory_bytes', 'gauge', "Resident memory size in bytes.",
+               [f'process_resident_memory_bytes {rss}'])
+    metric('process_cpu_seconds_total', 'counter', "User and system CPU time in seconds.",
+           [f'process_cpu_seconds_total {cpu_seconds()}'])
+    metric('process_peak_resident_memory_bytes', 'gauge', "Peak resident memory size in bytes.",
+           [f'process_peak_resident_memory_bytes {peak_rss_bytes()}'])
+    return '\n'.join(out) + '\n'
+
+
+class MetricsHandler(RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(render())
+
+
+class LogReporter:
+    # One summary line per call: sessions, memory, CPU, and the updates run
+    # since the previous line with their mean total time.
+    def __init__(self):
+        self._seen = {}
+        self._cpu = cpu_seconds()
+        self._time = time.monotonic()
+
+    def __call__(self):
+        now, cpu = time.monotonic(), cpu_seconds()
+        busy = (cpu - self._cpu) / (now - self._time) if now > self._time else 0.0
+        self._cpu, self._time = cpu, now
+        updates = []
+        for (name, phase), h in sorted(update_seconds.items()):
+            if phase != 'total':
+                continue
+            count, total = h.count, h.sum
+            seen_count, seen_total = self._seen.get(name, (0, 0.0))
+            self._seen[name] = count, total
+            if count > seen_count:
+                updates.append(f'{name} {count - seen_count}x{1000 * (total - seen_total) / (count - seen_count):.0f}ms')
+        rss = rss_bytes()
+        log.info("metrics: %d sessions, %s MB RSS, %.0f%% CPU, updates: %s",
+                 sessions['active'], '?' if rss is None else f'{rss / 2**20:.0f}', 100 * busy,
+                 ', '.join(updates) or 'none')
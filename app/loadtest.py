@@ -0,0 +1,393 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import numpy as np
+from bokeh.client import pull_session
+from bokeh.core.serialization import Serializable
+from bokeh.document.events import MessageSentEvent
+
+import instrumentation
+import sharedstore
+
+# Concurrent-session load test against a local server started with serve.py:
+#
+#   python app/loadtest.py [--sessions 1 5 10 20] [--num-procs 1 2] [--iterations 5] [--out load.json]
+#   python app/loadtest.py --url http://localhost:5006/app --sessions 10   # a server already running
+#
+# For every --num-procs setting a fresh server is started; for every N in
+# --sessions, N client sessions are opened with bokeh.client, each on its own
+# thread, and replay the same script concurrently --iterations times:
+# change export type, toggle value type, Top 15, reset, pick a country. An
+# action's round trip lasts from the client-side change until a patch it
+# causes has been applied on the client (see ACTIONS), so select changes
+# include the scheduler's debounce.
+#
+# Per N it reports connect time, p50/p95/p99 latency (overall and per action),
+# completed actions per second, CPU used by the server processes as a share
+# of all CPUs, and the server's memory (PSS, summed over its processes) and
+# its growth per open session. The clients run on the same machine and
+# compete with the server for CPU; their own CPU share is listed next to the
+# server's.
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = '/app'
+DEFAULT_SESSIONS = (1, 5, 10, 20)
+DEFAULT_TIMEOUT = 30.0
+STARTUP_TIMEOUT = 300.0
+PERCENTILES = (50, 95, 99)
+
+# Action -> (model name, attribute) whose change from the server completes it.
+# Type changes wait for the world chart's title: its data can stay the same
+# (World is 100 "% of total" for every export type).
+ACTIONS = {
+    'export_type': ('world_line_chart', 'title.text'),
+    'value_type': ('world_line_chart', 'title.text'),
+    'top15': ('top15_chart', 'x_range.factors'),
+    'reset': ('geo_source', 'data'),
+    'country': ('selected_table_source', 'data'),
+}
+
+log = logging.getLogger(__name__)
+
+
+class ButtonClick(Serializable):
+    # The event a browser sends when a Button is clicked.
+    def __init__(self, button):
+        self.button = button
+
+    def to_serializable(self, serializer):
+        return dict(type='event', name='button_click', values=dict(model=serializer.encode(self.button)))
+
+
+# --- CLIENT SESSIONS ---
+
+class Client:
+    def __init__(self, url, index, timeout):
+        self.index = index
+        self.timeout = timeout
+        start = time.perf_counter()
+        self.session = pull_session(url=url)
+        self.connect_ms = (time.perf_counter() - start) * 1000
+        self.doc = self.session.document
+        self.models = {name: self.doc.select_one(dict(name=name))
+                       for name in ('select_type', 'select_value_type', 'select_country', 'top15_button',
+                                    'reset_button', 'world_line_chart', 'geo_source', 'selected_table_source',
+                                    'top15_chart')}
+        self.changed = set()
+        self.doc.on_change(self.record)
+        self.latencies = []   # (action, ms), or (action, None) on timeout
+        # Each client walks the options from its own offset.
+        self.export_types = itertools.islice(itertools.cycle(self.models['select_type'].options), index + 1, None)
+        self.countries = itertools.islice(itertools.cycle(self.models['select_country'].options), index * 7, None)
+
+    def record(self, event):
+        if getattr(event, 'setter', None) is self.session and hasattr(event, 'model'):
+            self.changed.add((event.model.id, event.attr))
+
+    def completion_key(self, action):
+        name, attr = ACTIONS[action]
+        model = self.models[name]
+        while '.' in attr:
+            head, attr = attr.split('.', 1)
+            model = getattr(model, head)
+        return model.id, attr
+
+    def wait_for(self, key):
+        # Runs the client loop, applying server patches, until `key` changed
+        # or the timeout passed. A timeout stops the loop through a server
+        # info request, so the loop is never stopped in the middle of a read.
+        conn = self.session._connection
+        expired = []
+
+        def expire():
+            expired.append(True)
+            if conn._socket is None:
+                conn._loop.stop()
+            else:
+                conn._loop.add_callback(conn.send_message, conn._protocol.create('SERVER-INFO-REQ'))
+        handle = conn._loop.call_later(self.timeout, expire)
+        try:
+            conn._loop_until(lambda: key in self.changed or bool(expired))
+        finally:
+            conn._loop.remove_timeout(handle)
+        return key in self.changed
+
+    def act(self, action):
+        key = self.completion_key(action)
+        self.changed.clear()
+        start = time.perf_counter()
+        if action == 'export_type':
+            select = self.models['select_type']
+            select.value = next(t for t in self.export_types if t != select.value)
+        elif action == 'value_type':
+            select = self.models['select_value_type']
+            select.value = next(t for t in select.options if t != select.value)
+        elif action in ('top15', 'reset'):
+            button = self.models['top15_button' if action == 'top15' else 'reset_button']
+            self.doc.callbacks.trigger_on_change(MessageSentEvent(self.doc, 'bokeh_event', ButtonClick(button)))
+        elif action == 'country':
+            select = self.models['select_country']
+            select.value = next(c for c in self.countries if c != select.value)
+        done = self.wait_for(key)
+        self.latencies.append((action, (time.perf_counter() - start) * 1000 if done else None))
+
+    def run(self, iterations, think):
+        for _ in range(iterations):
+            for action in ACTIONS:
+                self.act(action)
+                if think:
+                    time.sleep(think)
+
+    def close(self):
+        self.session.close()
+
+
+def run_level(url, sessions, iterations, think, timeout, server_pid):
+    # Opens `sessions` clients, replays the script on all of them at once
+    # and closes them again.
+    memory_before = server_memory_mb(server_pid)
+    clients, errors = [None] * sessions, []
+    ready = threading.Barrier(sessions + 1)
+
+    def client_thread(i):
+        try:
+            clients[i] = Client(url, i, timeout)
+        except Exception as e:
+            errors.append(repr(e))
+        ready.wait()
+        ready.wait()
+        if clients[i] is not None:
+            try:
+                clients[i].run(iterations, think)
+            except Exception as e:
+                errors.append(repr(e))
+
+    threads = [threading.Thread(target=client_thread, args=(i,), daemon=True) for i in range(sessions)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    clients_open = [c for c in clients if c is not None]
+    memory_open = server_memory_mb(server_pid)
+    cpu_start, client_cpu_start = server_cpu_seconds(server_pid), instrumentation.cpu_seconds()
+    start = time.perf_counter()
+    ready.wait()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    cpu_end, client_cpu_end = server_cpu_seconds(server_pid), instrumentation.cpu_seconds()
+    for client in clients_open:
+        client.close()
+
+    latencies = [(a, ms) for c in clients_open for a, ms in c.latencies]
+    done = [ms for _, ms in latencies if ms is not None]
+    result = dict(
+        sessions=sessions,
+        opened=len(clients_open),
+        errors=errors,
+        timeouts=sum(ms is None for _, ms in latencies),
+        connect_ms=summary([c.connect_ms for c in clients_open]),
+        latency_ms=summary(done),
+        actions=dict((action, summary([ms for a, ms in latencies if a == action and ms is not None]))
+                     for action in ACTIONS),
+        wall_s=wall,
+        actions_per_s=len(done) / wall if wall else None,
+        client_cpu=(client_cpu_end - client_cpu_start) / wall / os.cpu_count() if wall else None,
+        server_cpu=None,
+        server_mb=memory_open,
+        per_session_mb=None,
+    )
+    if cpu_start is not None and wall:
+        result['server_cpu'] = (cpu_end - cpu_start) / wall / os.cpu_count()
+    if memory_before is not None and clients_open:
+        result['per_session_mb'] = (memory_open - memory_before) / len(clients_open)
+    return result
+
+
+def summary(values):
+    if not values:
+        return None
+    result = {f'p{q}': float(np.percentile(values, q)) for q in PERCENTILES}
+    result.update(mean=statistics.mean(values), count=len(values))
+    return result
+
+
+# --- SERVER PROCESSES ---
+
+def server_processes(pid):
+    # `pid` and its descendants (the workers of --num-procs), from /proc.
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    stat = f.read()
+            except OSError:
+                continue
+            parents[int(entry)] = int(stat.rsplit(')', 1)[1].split()[1])
+    found, frontier = {pid}, [pid]
+    while frontier:
+        parent = frontier.pop()
+        children = [p for p, pp in parents.items() if pp == parent and p not in found]
+        found.update(children)
+        frontier.extend(children)
+    return sorted(found)
+
+
+def server_cpu_seconds(pid):
+    if pid is None:
+        return None
+    total = 0
+    for p in server_processes(pid):
+        try:
+            with open(f'/proc/{p}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        total += int(fields[11]) + int(fields[12])   # utime, stime
+    return total / os.sysconf('SC_CLK_TCK')
+
+
+def server_memory_mb(pid):
+    # Proportional set size summed over the server processes, so pages the
+    # workers share (forked or mapped, see sharedstore.py) count once;
+    # resident size where the kernel has no smaps_rollup.
+    if pid is None:
+        return None
+    total = 0
+    for p in server_processes(pid):
+        try:
+            with open(f'/proc/{p}/smaps_rollup') as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith('Pss:')) * 1024
+        except (OSError, StopIteration):
+            try:
+                with open(f'/proc/{p}/statm') as f:
+                    total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            except OSError:
+                continue
+    return total / 2**20
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, num_procs, shared_dir=None):
+    command = [sys.executable, os.path.join(APP_DIR, 'serve.py'), f'--port={port}', f'--num-procs={num_procs}',
+               f'--allow-websocket-origin=localhost:{port}']
+    if shared_dir:
+        command.append(f'--shared-dir={shared_dir}')
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    url = f'http://localhost:{port}{APP_PATH}'
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while True:
+        if server.poll() is not None:
+            raise RuntimeError(f"server exited with {server.returncode}: {' '.join(command)}")
+        try:
+            with urllib.request.urlopen(url, timeout=10):
+                return server, url
+        except OSError:
+            if time.monotonic() > deadline:
+                stop_server(server)
+                raise RuntimeError(f"server did not answer at {url} within {STARTUP_TIMEOUT:.0f}s")
+            time.sleep(0.5)
+
+
+def stop_server(server):
+    # The workers of --num-procs share the server's process group.
+    try:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(server.pid, signal.SIGKILL)
+        server.wait()
+    except ProcessLookupError:
+        pass
+
+
+# --- REPORT ---
+
+def fmt(value, spec='.0f'):
+    return '-' if value is None else format(value, spec)
+
+
+def print_results(results):
+    print(f"{'procs':>5}{'N':>5}{'conn p50':>9}{'p50':>8}{'p95':>8}{'p99':>8}{'act/s':>8}"
+          f"{'srv cpu':>8}{'cli cpu':>8}{'srv MB':>8}{'MB/sess':>8}{'t/o':>5}")
+    for run in results['runs']:
+        for r in run['levels']:
+            latency = r['latency_ms'] or {}
+            print(f"{fmt(run['num_procs']):>5}{r['sessions']:>5}{fmt((r['connect_ms'] or {}).get('p50')):>9}"
+                  f"{fmt(latency.get('p50')):>8}{fmt(latency.get('p95')):>8}{fmt(latency.get('p99')):>8}"
+                  f"{fmt(r['actions_per_s'], '.1f'):>8}{fmt(r['server_cpu'] and 100 * r['server_cpu']):>7}%"
+                  f"{fmt(r['client_cpu'] and 100 * r['client_cpu']):>7}%{fmt(r['server_mb']):>8}"
+                  f"{fmt(r['per_session_mb'], '.1f'):>8}{r['timeouts']:>5}")
+    print(f"\np95 by action (ms){'':5}" + ''.join(f'{a:>12}' for a in ACTIONS))
+    for run in results['runs']:
+        for r in run['levels']:
+            cells = [fmt((r['actions'][a] or {}).get('p95')) for a in ACTIONS]
+            print(f"{'procs ' + fmt(run['num_procs']) + ', N ' + str(r['sessions']):23}" + ''.join(f'{c:>12}' for c in cells))
+    for run in results['runs']:
+        for r in run['levels']:
+            for error in r['errors']:
+                print(f"procs {fmt(run['num_procs'])}, N {r['sessions']}: {error}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the app with concurrent bokeh.client sessions.")
+    parser.add_argument('--sessions', type=int, nargs='+', default=list(DEFAULT_SESSIONS),
+                        help="numbers of concurrent sessions to test, in order")
+    parser.add_argument('--num-procs', type=int, nargs='+', default=[1],
+                        help="serve.py --num-procs settings to compare")
+    parser.add_argument('--iterations', type=int, default=5, help="script repetitions per session")
+    parser.add_argument('--think-ms', type=float, default=0, help="pause between actions")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help="seconds before an action times out")
+    parser.add_argument('--url', help="test a running server at this app URL instead of starting one")
+    parser.add_argument('--port', type=int, help="port for the started server (default: a free one)")
+    parser.add_argument('--out', help="write results as JSON to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    logging.getLogger('bokeh').setLevel(logging.ERROR)
+    runs = []
+    # Multi-worker servers share their store through this directory (see
+    # sharedstore.py), removed afterwards.
+    with tempfile.TemporaryDirectory(prefix='loadtest-', dir=sharedstore.BASE_DIR) as shared_dir:
+        for num_procs in [None] if args.url else args.num_procs:
+            server, url = (None, args.url) if args.url else start_server(
+                args.port or free_port(), num_procs, shared_dir if num_procs != 1 else None)
+            try:
+                levels = []
+                for n in args.sessions:
+                    log.info("procs %s: %d sessions", num_procs or '?', n)
+                    levels.append(run_level(url, n, args.iterations, args.think_ms / 1000, args.timeout,
+                                            server and server.pid))
+                runs.append(dict(num_procs=num_procs, url=url, levels=levels))
+            finally:
+                if server is not None:
+                    stop_server(server)
+    results = dict(cpus=os.cpu_count(), iterations=args.iterations, think_ms=args.think_ms, runs=runs)
+    print_results(results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,59 +1,31 @@
-import geopandas as gpd
+import time
+
 import pandas as pd
 import numpy as np
-import difflib
-import matplotlib.colors as mcolors
-import re
 
+from bokeh.events import RangesUpdate
 from bokeh.io import curdoc
 from bokeh.models import (
-    GeoJSONDataSource, Select, Button, ColumnDataSource, HoverTool, Div, Label,NumeralTickFormatter, DatetimeTickFormatter,
-    DataTable, TableColumn, HTMLTemplateFormatter, ColorBar, LinearColorMapper, CustomJS
+    Select, Button, ColumnDataSource, HoverTool, Div, Label,NumeralTickFormatter, DatetimeTickFormatter,
+    DataTable, TableColumn, HTMLTemplateFormatter, ColorBar, LinearColorMapper, CustomJS, Slider, Span, Toggle, TapTool
 )
 
 from bokeh.plotting import figure
 from bokeh.layouts import column, row
 from bokeh.themes import Theme
 
+from datastore import DEFAULT_TYPE, DEFAULT_VALUE_TYPE, REGION_COLUMNS, WORLD_COUNTRY, get_store, subscribe, unsubscribe
+from export import EXPORT_PATH
+from metrics import is_usd
+from scheduler import Update, UpdateScheduler
+from styling import smooth_palette, theme_json
+import instrumentation
+
+session_started = time.perf_counter()
+
 # --- THEME ---
-theme_json = {
-    'attrs': {
-        'figure': {
-            'background_fill_color': '#228B22',
-            'background_fill_alpha': 0.05,
-        },
-        'Axis': {
-            'axis_label_text_font': 'Georgia',
-            'major_label_text_font': 'Georgia',
-        },
-        'Title': {
-            'text_font_style': 'bold',
-            'text_font': 'Georgia',
-            'text_font_size': '18px',
-        },
-        'Legend': {
-            'label_text_font': 'Georgia',
-            'padding': 1,
-            'spacing': 1,
-            'background_fill_alpha': 0.7,
-        },
-    }
-}
 curdoc().theme = Theme(json=theme_json)
 
-# --- PALETTE ---
-blues = [
-    "#c6dbef", "#9ecae1", "#6baed6", "#4292c6", "#2171b5", "#08519c", "#08306b"
-]
-greens = [
-    "#c7e9c0", "#a1d99b", "#74c476", "#41ab5d", "#238b45", "#006d2c", "#00441b"
-]
-palette = blues[::-1] + greens
-def interpolate_palette(palette, n):
-    cmap = mcolors.LinearSegmentedColormap.from_list('custom', palette)
-    return [mcolors.to_hex(cmap(i/(n-1))) for i in range(n)]
-smooth_palette = interpolate_palette(palette, 50)
-
 formatter = HTMLTemplateFormatter(
     template="""
     <style>
@@ -67,137 +39,99 @@ formatter = HTMLTemplateFormatter(
 )
 
 # --- DATA LOAD ---
-world = gpd.read_file('app/data/ne_10m_admin_0_countries.shp')
-df = pd.read_csv('app/data/auto_total.csv')
-date_col = None
-for col in df.columns:
-    if re.search('date', col, re.IGNORECASE):
-        date_col = col
-        df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
-        break
-
-
-
-
-# --- COUNTRY COLUMN MAP ---
-country_type_value_to_col = {}
-export_types = set()
-value_types = set()
-for col in df.columns:
-    m1 = re.match(r'Exports, Autos, (\w+), (.*?), USD m', col)
-    m2 = re.match(r'Exports, Autos, (\w+), (.*?), % of total', col)
-    if m1:
-        exp_type = m1.group(1)
-        country = m1.group(2)
-        export_types.add(exp_type)
-        value_types.add('USD m')
-        country_type_value_to_col.setdefault(country, {}).setdefault(exp_type, {})['USD m'] = col
-    elif m2:
-        exp_type = m2.group(1)
-        country = m2.group(2)
-        export_types.add(exp_type)
-        value_types.add('% of total')
-        country_type_value_to_col.setdefault(country, {}).setdefault(exp_type, {})['% of total'] = col
-
-country_list = list(country_type_value_to_col.keys())
-export_types = sorted(list(export_types))
-value_types = sorted(list(value_types))
-
-default_type = "Total"
-default_value_type = "USD m"
-if default_type not in export_types:
-    export_types.insert(0, default_type)
-if default_value_type not in value_types:
-    value_types.insert(0, default_value_type)
-
-select_type = Select(title="Export Type", value=default_type, options=export_types, width=220)
-select_value_type = Select(title="Value Type", value=default_value_type, options=value_types, width=220)
-
-# --- COUNTRY MATCHING ---
-def has_match(admin_name):
-    match = difflib.get_close_matches(admin_name, country_list, n=1, cutoff=0.7)
-    return bool(match)
-filtered_world = world[world['ADMIN'].apply(has_match)].reset_index(drop=True)
-admin_to_df_map = {}
-for admin_name in filtered_world['ADMIN']:
-    match = difflib.get_close_matches(admin_name, country_list, n=1, cutoff=0.7)
-    admin_to_df_map[admin_name] = match[0] if match else None
-
-if not (filtered_world["ADMIN"] == "China").any():
-    china_row = world[world["ADMIN"] == "China"]
-    filtered_world = pd.concat([filtered_world, china_row], ignore_index=True)
+# Shared, read-only data is loaded once per server process (see
+# server_lifecycle.py); each session only builds its own widgets and sources.
+store = get_store()
+export_types = store.export_types
+value_types = store.value_type_options
+admin_to_df_map = store.admin_to_df_map
 
-# --- EXPORTS DATA INIT ---
-latest_row = df.iloc[-1]
-country_exports = {}
-for admin_name, df_country in admin_to_df_map.items():
-    df_col = country_type_value_to_col.get(df_country, {}).get(default_type, {}).get(default_value_type)
-    if df_col and df_col in df.columns:
-        country_exports[admin_name] = latest_row[df_col]
-    else:
-        country_exports[admin_name] = None
+default_type = DEFAULT_TYPE
+default_value_type = DEFAULT_VALUE_TYPE
 
-filtered_world["exports"] = filtered_world["ADMIN"].map(country_exports)
-if default_value_type == 'USD m':
-    filtered_world["exports_log"] = filtered_world["exports"].apply(
-        lambda x: np.log1p(x) if pd.notnull(x) and x > 0 else None
+select_type = Select(title="Export Type", value=default_type, options=export_types, width=220, name="select_type")
+select_value_type = Select(title="Value Type", value=default_value_type, options=value_types, width=220,
+                           name="select_value_type")
+
+admin_names = store.world["ADMIN"].to_numpy()
+
+# --- EXPORTS DATA INIT ---
+month_labels = store.dates.dt.strftime('%b-%y').tolist() if store.date_col else [str(d) for d in store.dates]
+latest_month = len(store.dates) - 1
+palette_colors = np.array(smooth_palette + ["#dddddd"], dtype=object)
+exporter_rows = np.flatnonzero(admin_names == "China")
+
+# The functions computing callback payloads only read the shared store and
+# their arguments, so they can run in the worker pool; the document is only
+# touched when their results are applied.
+def map_notes(values, grouping=None):
+    note = np.where(np.isnan(values), "No Data", "").astype(object)
+    if grouping is None:
+        note[exporter_rows] = "Exporter (no data)"
+    return note.tolist()
+
+def map_columns(exp_type, value_type, t, grouping=None):
+    # Map columns for one month from the shared precomputed frames, plus the
+    # color scale bounds for that month. `grouping` selects a region rollup
+    # instead of countries.
+    frames = store.frames(exp_type, value_type, len(smooth_palette), grouping)
+    columns = dict(
+        exports=frames.values[t].copy(),
+        exports_log=frames.plot[t].copy(),
+        note=map_notes(frames.values[t], grouping),
+        custom_color=palette_colors[np.minimum(frames.color_idx[t], len(smooth_palette))].tolist(),
     )
-else:
-    filtered_world["exports_log"] = filtered_world["exports"]
-filtered_world["note"] = filtered_world["exports"].apply(
-    lambda x: "No Data" if pd.isnull(x) else ""
-)
-filtered_world.loc[filtered_world["ADMIN"] == "China", "note"] = "Exporter (no data)"
-
-def get_colors(export_values, palette, vmin, vmax, highlight_admins=None):
-    export_values = np.array(export_values, dtype=float)
-    norm = (export_values - vmin) / (vmax - vmin) if (vmax - vmin) != 0 else np.zeros_like(export_values)
-    norm = np.clip(norm, 0, 1)
-    idx = (norm * (len(palette)-1)).round().astype(int)
-    colors = []
-    for admin, v, i in zip(filtered_world["ADMIN"], export_values, idx):
-        if np.isnan(v):
-            colors.append("#dddddd")
-        elif highlight_admins is not None and admin not in highlight_admins:
-            colors.append("#dddddd")
-        else:
-            colors.append(palette[i])
-    return colors
+    return columns, frames.low[t], frames.high[t]
+
+initial_map_columns, exports_log_min, exports_log_max = map_columns(default_type, default_value_type, latest_month)
 
-exports_log_min = filtered_world["exports_log"].min()
-exports_log_max = filtered_world["exports_log"].max()
-exports_log = filtered_world["exports_log"].values
-filtered_world["custom_color"] = get_colors(exports_log, smooth_palette, exports_log_min, exports_log_max)
-columns_to_keep = ['ADMIN', 'exports', 'exports_log', 'note', 'custom_color', 'geometry']
-filtered_world_small = filtered_world[columns_to_keep]
-geo_source = GeoJSONDataSource(geojson=filtered_world_small.to_json())
+# The polygons are sent once with the document and never change afterwards;
+# callbacks only push the value and color columns to the client. Every
+# session starts on the coarsest geometry; the lists are per-session so
+# level-of-detail patches never touch the shared arrays.
+geo_source = ColumnDataSource(data=dict(
+    xs=list(store.lod_xs[0]), ys=list(store.lod_ys[0]), ADMIN=admin_names.tolist(), **initial_map_columns
+), name="geo_source")
 
 # --- WORLD TIMESERIES ---
-world_country = 'World'
-world_chart_source = ColumnDataSource(data=dict(date=[], value=[]))
+world_country = WORLD_COUNTRY
+world_chart_source = ColumnDataSource(data=dict(date=[], value=[]), name="world_chart_source")
+def round_or_none(values):
+    values = pd.Series(values, dtype=float).round(1)
+    return values.astype(object).where(values.notnull(), None).tolist()
+
 def get_world_timeseries(export_type, value_type):
-    world_col = country_type_value_to_col.get(world_country, {}).get(export_type, {}).get(value_type)
-    if world_col and world_col in df.columns:
-        if date_col and date_col in df.columns:
-            dates = df[date_col].tolist()
-        else:
-            dates = df.index.tolist()
-        values = df[world_col].apply(lambda x: round(x,1) if pd.notnull(x) else None).tolist()
-        return dict(date=dates, value=values)
+    if store.country_index(world_country) >= 0:
+        values = store.series(world_country, export_type, value_type)
+        return dict(date=store.dates.tolist(), value=round_or_none(values))
     else:
         return dict(date=[], value=[])
 
-def update_world_chart():
-    export_type = select_type.value
-    value_type = select_value_type.value
-    new_data = get_world_timeseries(export_type, value_type)
+def update_world_chart(export_type, value_type, new_data):
     world_line_chart.title.text = f"World Monthly Auto Exports ({export_type}, {value_type})"
     world_chart_source.data = new_data
 
+# --- REGION TIMESERIES ---
+region_chart_source = ColumnDataSource(data=dict(date=[], value=[]))
+
+def get_region_timeseries(grouping, region, export_type, value_type):
+    if grouping is None or region is None:
+        return dict(date=[], value=[])
+    values = store.rollups[grouping].series(region, export_type, value_type)
+    return dict(date=store.dates.tolist(), value=round_or_none(values))
+
 # --- WIDGETS ---
-select_country = Select(title="Select Country", value="", options=sorted(list(admin_to_df_map.keys())), width=220)
-top15_button = Button(label="Highlight Top 15", button_type="success", width=220, height=35)
-reset_button = Button(label="🔄", button_type="default", width=40, height=35)
+select_country = Select(title="Select Country", value="", options=sorted(list(admin_to_df_map.keys())), width=220,
+                        name="select_country")
+top15_button = Button(label="Highlight Top 15", button_type="success", width=220, height=35, name="top15_button")
+reset_button = Button(label="🔄", button_type="default", width=40, height=35, name="reset_button")
+# Ranking length and period; trailing windows rank by the sum of USD values
+# (or the mean share) over the last months up to the selected one.
+top_n_options = ["5", "10", "15", "20", "25", "50"]
+rank_windows = {"Month": 1, "Trailing 3 months": 3, "Trailing 12 months": 12}
+select_top_n = Select(title="Top N", value="15", options=top_n_options, width=100, name="select_top_n")
+select_rank_window = Select(title="Rank by", value="Month", options=list(rank_windows), width=160,
+                            name="select_rank_window")
 
 country_width = 250
 date_width = 200
@@ -205,31 +139,36 @@ cat_width = 350
 top_15_width = country_width + cat_width
 total_width = date_width + cat_width
 
-top15_table_source = ColumnDataSource(data=dict(country=[], value=[]))
+rank_change_formatter = HTMLTemplateFormatter(
+    template="""<%= (value == null) ? "" : (value > 0 ? "▲ " + value : (value < 0 ? "▼ " + (-value) : "=")) %>"""
+)
+
+# Shared by the Top 15 table and bar chart, so one update refreshes both.
+top15_source = ColumnDataSource(data=dict(country=[], value=[], change=[]))
 top15_table = DataTable(
-    source=top15_table_source,
+    source=top15_source,
     columns=[
         TableColumn(field="country", title="Country", width=country_width),
-        TableColumn(field="value", title=f"Exports ({default_type}, {default_value_type})", width=cat_width, formatter=formatter)
+        TableColumn(field="value", title=f"Exports ({default_type}, {default_value_type})", width=cat_width, formatter=formatter),
+        TableColumn(field="change", title="Rank change", width=100, formatter=rank_change_formatter),
     ],
     width=top_15_width,
     height=350,
     index_position=None,
 )
-top15_chart_source = ColumnDataSource(data=dict(country=[], value=[]))
 top15_chart = figure(
     x_range=[], height=350, width=370, title=f"Top 15 destinations, {default_type}, {default_value_type}", toolbar_location=None, tools="",
-    min_border_left=10, min_border_right=10, min_border_top=10, min_border_bottom=10
+    min_border_left=10, min_border_right=10, min_border_top=10, min_border_bottom=10, name="top15_chart"
 )
-top15_chart.vbar(x="country", top="value", source=top15_chart_source, width=0.7, color="#556B2F", alpha=0.7)
+top15_chart.vbar(x="country", top="value", source=top15_source, width=0.7, color="#556B2F", alpha=0.7)
 top15_chart.xaxis.major_label_orientation = 1.0
 top15_chart.xgrid.grid_line_color = None
 top15_chart.title.text_font_size = "14px"
-selected_table_source = ColumnDataSource(data=dict(index=[], date=[], exports=[]))
+selected_table_source = ColumnDataSource(data=dict(index=[], date=[], exports=[]), name="selected_table_source")
 
 # --- WORLD CHART ---
 world_line_chart = figure(
-    height=220, width=600,
+    height=220, width=600, name="world_line_chart",
     title="Monthly World Auto Exports",
     x_axis_type="datetime",
     tools="pan,xwheel_zoom,box_zoom,reset,save",
@@ -239,8 +178,19 @@ world_line_chart.line(x="date", y="value", source=world_chart_source, line_width
 world_line_chart.yaxis.formatter = NumeralTickFormatter(format="0,0.0")
 world_line_chart.xaxis.formatter = DatetimeTickFormatter(years="%b-%y", months="%b-%y")
 
+region_line_chart = figure(
+    height=220, width=600,
+    title="Select a region on the map",
+    x_axis_type="datetime",
+    tools="pan,xwheel_zoom,box_zoom,reset,save",
+    margin=(20, 10, 10, 10)
+)
+region_line_chart.line(x="date", y="value", source=region_chart_source, line_width=2, color="#238b45")
+region_line_chart.yaxis.formatter = NumeralTickFormatter(format="0,0.0")
+region_line_chart.xaxis.formatter = DatetimeTickFormatter(years="%b-%y", months="%b-%y")
+
 # --- FILL INITIAL DATA ---
-update_world_chart()
+update_world_chart(default_type, default_value_type, get_world_timeseries(default_type, default_value_type))
 
 # --- MAIN MAP ---
 TOOLS = "pan,wheel_zoom,box_zoom,reset,hover,save"
@@ -258,78 +208,203 @@ p.add_layout(Label(x=10, y=10, x_units='screen', y_units='screen', text=f"www.ea
 p.xaxis.axis_label = f'Source: CCA, EEA'
 patches = p.patches('xs', 'ys', source=geo_source, fill_color='custom_color',
     fill_alpha=0.7, line_color="gray", line_width=0.5)
+
+# --- MAP LEVEL OF DETAIL ---
+# Level currently on the client per row; only rows in view whose level
+# differs are patched, so off-screen countries are never re-sent.
+map_level = np.zeros(len(admin_names), dtype=int)
+
+def update_level_of_detail(event):
+    if None in (event.x0, event.x1, event.y0, event.y1):
+        return
+    level = store.level_of_detail(abs(event.x1 - event.x0))
+    rows = store.rows_in_view(event.x0, event.x1, event.y0, event.y1)
+    rows = rows[map_level[rows] != level]
+    if len(rows) == 0:
+        return
+    map_level[rows] = level
+    with instrumentation.recording(doc):
+        geo_source.patch(dict(
+            xs=[(int(i), store.lod_xs[level][i]) for i in rows],
+            ys=[(int(i), store.lod_ys[level][i]) for i in rows],
+        ))
+p.on_event(RangesUpdate, instrumentation.timed_handler('map.ranges_update', update_level_of_detail))
+
+# --- REGION VIEWS ---
+# One hidden renderer per region rollup, filled the first time its view is
+# shown; switching views then only toggles visibility and looks up the
+# precomputed region frames. Regions are drawn on the coarsest geometry and
+# can be clicked to chart their series.
+map_views = {"Countries": None}
+map_views.update({REGION_COLUMNS[grouping]: grouping for grouping in store.rollups})
+select_map_view = Select(title="Map View", value="Countries", options=list(map_views), width=220,
+                         name="select_map_view")
+
+region_sources = {}
+map_renderers = {None: patches}
+for grouping in store.rollups:
+    region_sources[grouping] = ColumnDataSource(data=dict(
+        xs=[], ys=[], ADMIN=[], exports=[], exports_log=[], note=[], custom_color=[]
+    ))
+    map_renderers[grouping] = p.patches('xs', 'ys', source=region_sources[grouping], fill_color='custom_color',
+        fill_alpha=0.7, line_color="gray", line_width=0.5, visible=False)
+if region_sources:
+    p.add_tools(TapTool(renderers=[map_renderers[grouping] for grouping in region_sources]))
+
+def map_source(grouping):
+    return geo_source if grouping is None else region_sources[grouping]
+
+def map_title(exp_type, value_type, grouping):
+    if grouping is None:
+        return f"Automobile Exports by Country ({exp_type}, {value_type})"
+    return f"Automobile Exports by Region, {REGION_COLUMNS[grouping]} ({exp_type}, {value_type})"
+
 hover = p.select_one(HoverTool)
 hover.point_policy = "follow_mouse"
-hover.tooltips = [
-    ("Country", "@ADMIN"),
-    (f"Exports ({default_value_type})", "@exports{0,0.0}"),
-    ("Note", "@note")
-]
-
-download_timeseries_button = Button(label="Download Timeseries CSV", button_type="primary", width=220, height=35)
-download_top15_button = Button(label="Download Top 15 CSV", button_type="primary", width=220, height=35)
-
-# Download for country selection (timeseries) table
-download_timeseries_button.js_on_click(CustomJS(args=dict(source=selected_table_source), code="""
-    function toCSV(data) {
-        const cols = Object.keys(data);
-        if (cols.length === 0) { return ""; }
-        const nrows = data[cols[0]].length;
-        const lines = [cols.join(",")];
-        for (let i = 0; i < nrows; i++) {
-            lines.push(cols.map(col => 
-                (data[col][i] == null ? "" : `"${data[col][i]}"`)
-            ).join(","));
-        }
-        return lines.join("\\n");
+def exports_label(value_type, window=1):
+    # What the map's exports column holds: the month's value, or while a
+    # trailing-window highlight is shown, the trailing sum (USD) or mean
+    # (shares) it ranks by.
+    if window == 1:
+        return f"Exports ({value_type})"
+    return f"Exports ({value_type}, {window}-month {'sum' if is_usd(value_type) else 'mean'})"
+
+def hover_tooltips(value_type, window=1):
+    return [("Country", "@ADMIN"), (exports_label(value_type, window), "@exports{0,0.0}"), ("Note", "@note")]
+
+hover.tooltips = hover_tooltips(default_value_type)
+
+# --- MONTH SLIDER ---
+# Every month's values and palette indices for the current selection live on
+# the client as typed arrays, so stepping or animating through months runs
+# entirely in the browser. They are only re-sent when the export type or
+# value type changes.
+def frame_data(exp_type, value_type, grouping=None):
+    frames = store.frames(exp_type, value_type, len(smooth_palette), grouping)
+    return (
+        dict(exports=frames.values32.ravel(), color_idx=frames.color_idx.ravel()),
+        dict(low=frames.low, high=frames.high),
+        ['log1p'] if frames.log_scale else [],
+    )
+
+frames_data, frame_range_data, frames_tags = frame_data(default_type, default_value_type)
+frames_source = ColumnDataSource(data=frames_data, tags=frames_tags)
+frame_range_source = ColumnDataSource(data=dict(
+    label=month_labels, date=store.dates.tolist(), **frame_range_data
+))
+
+month_slider = Slider(start=0, end=latest_month, value=latest_month, step=1, show_value=False,
+                      title=f"Month: {month_labels[latest_month]}", width=600, name="month_slider")
+play_button = Toggle(label="► Play", button_type="success", width=90, height=35)
+month_span = Span(location=store.dates.iloc[latest_month], dimension="height",
+                  line_color="#104b1f", line_dash="dashed", line_width=1)
+world_line_chart.add_layout(month_span)
+
+month_slider.js_on_change('value', CustomJS(args=dict(
+    slider=month_slider, geo_source=geo_source, renderers=list(map_renderers.values()),
+    frames=frames_source, ranges=frame_range_source,
+    color_mapper=color_mapper_obj, span=month_span, palette=smooth_palette,
+    exporter_rows=exporter_rows.tolist(),
+), code="""
+    const t = slider.value;
+    const source = renderers.find(r => r.visible).data_source;
+    const data = source.data;
+    const n = data.exports.length;
+    const values = frames.data.exports;
+    const color_idx = frames.data.color_idx;
+    const log_scale = frames.tags.includes('log1p');
+    for (let i = 0; i < n; i++) {
+        const v = values[t * n + i];
+        const c = color_idx[t * n + i];
+        data.exports[i] = v;
+        data.exports_log[i] = log_scale ? (v > 0 ? Math.log1p(v) : NaN) : v;
+        data.note[i] = isNaN(v) ? "No Data" : "";
+        data.custom_color[i] = c < palette.length ? palette[c] : "#dddddd";
     }
-    const csv = toCSV(source.data);
-    const blob = new Blob([csv], { type: 'text/csv;charset=utf-8;' });
-    const link = document.createElement("a");
-    link.href = URL.createObjectURL(blob);
-    link.download = "timeseries.csv";
-    document.body.appendChild(link);
-    link.click();
-    document.body.removeChild(link);
+    if (source === geo_source) {
+        for (const i of exporter_rows) { data.note[i] = "Exporter (no data)"; }
+    }
+    color_mapper.low = ranges.data.low[t];
+    color_mapper.high = ranges.data.high[t];
+    span.location = ranges.data.date[t];
+    slider.title = "Month: " + ranges.data.label[t];
+    source.change.emit();
 """))
 
-# Download for top 15 table
-download_top15_button.js_on_click(CustomJS(args=dict(source=top15_table_source), code="""
-    function toCSV(data) {
-        const cols = Object.keys(data);
-        if (cols.length === 0) { return ""; }
-        const nrows = data[cols[0]].length;
-        const lines = [cols.join(",")];
-        for (let i = 0; i < nrows; i++) {
-            lines.push(cols.map(col => 
-                (data[col][i] == null ? "" : `"${data[col][i]}"`)
-            ).join(","));
-        }
-        return lines.join("\\n");
+# The timer id is kept on the JS model object as a plain field rather than
+# in a Bokeh property, so it stays client-side and is never synced.
+play_button.js_on_change('active', CustomJS(args=dict(slider=month_slider, toggle=play_button), code="""
+    if (toggle.active) {
+        toggle.label = "❚❚ Pause";
+        if (slider.value >= slider.end) { slider.value = slider.start; }
+        clearInterval(toggle._play_timer);
+        toggle._play_timer = setInterval(() => {
+            if (slider.value >= slider.end) { toggle.active = false; }
+            else { slider.value = slider.value + 1; }
+        }, 150);
+    } else {
+        clearInterval(toggle._play_timer);
+        toggle._play_timer = undefined;
+        toggle.label = "► Play";
     }
-    const csv = toCSV(source.data);
-    const blob = new Blob([csv], { type: 'text/csv;charset=utf-8;' });
+"""))
+
+download_timeseries_button = Button(label="Download Timeseries", button_type="primary", width=220, height=35)
+download_top15_button = Button(label="Download Top 15", button_type="primary", width=220, height=35)
+select_export_format = Select(title="Format", value="CSV", options=["CSV", "Parquet"], width=100)
+
+# Downloads are streamed by the server's export endpoint (export.py), so
+# they cover the full history rather than what the session has loaded.
+export_js = """
+    const params = new URLSearchParams();
+    for (const country of countries) { params.append("country", country); }
+    params.append("type", select_type.value);
+    params.append("value_type", select_value_type.value);
+    params.append("format", export_format.value.toLowerCase());
     const link = document.createElement("a");
-    link.href = URL.createObjectURL(blob);
-    link.download = "top15.csv";
+    link.href = export_path + "?" + params.toString();
     document.body.appendChild(link);
     link.click();
     document.body.removeChild(link);
-"""))
+"""
+export_args = dict(select_type=select_type, select_value_type=select_value_type,
+                   export_format=select_export_format, export_path=EXPORT_PATH)
+
+# Full monthly series of the selected country
+download_timeseries_button.js_on_click(CustomJS(args=dict(select_country=select_country, **export_args), code="""
+    if (!select_country.value) { return; }
+    const countries = [select_country.value];
+""" + export_js))
+
+# Full monthly series of the highlighted top countries
+download_top15_button.js_on_click(CustomJS(args=dict(source=top15_source, **export_args), code="""
+    const countries = source.data.country;
+    if (countries.length === 0) { return; }
+""" + export_js))
 
 # --- CALLBACKS ---
-def reset_top15():
-    exports_log_min = filtered_world["exports_log"].min()
-    exports_log_max = filtered_world["exports_log"].max()
-    exports_log = filtered_world["exports_log"].values
-    filtered_world["custom_color"] = get_colors(exports_log, smooth_palette, exports_log_min, exports_log_max)
-    columns_to_keep = ['ADMIN', 'exports', 'exports_log', 'note', 'custom_color', 'geometry']
-    filtered_world_small = filtered_world[columns_to_keep]
-    geo_source.geojson = filtered_world_small.to_json()
-    top15_table_source.data = dict(country=[], value=[])
-    top15_chart_source.data = dict(country=[], value=[])
-    top15_chart.x_range.factors = []
-reset_button.on_click(reset_top15)
+# Widget events only queue updates; the scheduler runs each queued update
+# once per interaction inside a single document hold.
+scheduler = UpdateScheduler(curdoc())
+
+def clear_top15():
+    if top15_source.data["country"]:
+        top15_source.data = dict(country=[], value=[], change=[])
+        top15_chart.x_range.factors = []
+
+def current_selection():
+    return select_type.value, select_value_type.value, month_slider.value
+
+def current_view():
+    return map_views[select_map_view.value]
+
+def apply_reset_top15(result):
+    columns, _, _ = result
+    geo_source.data.update(columns)
+    hover.tooltips = hover_tooltips(select_value_type.value)
+    clear_top15()
+reset_top15 = Update(current_selection, map_columns, apply_reset_top15)
+scheduler.on_click(reset_button, reset_top15)
 
 def make_data_table_columns(export_type, value_type):
     return [
@@ -339,119 +414,279 @@ def make_data_table_columns(export_type, value_type):
 columns = make_data_table_columns(default_type, default_value_type)
 data_table = DataTable(source=selected_table_source, columns=columns, width=total_width, height=400, index_position=None, header_row=True)
 
-def update_selected(attr, old, new):
-    country = select_country.value
-    exp_type = select_type.value
-    value_type = select_value_type.value
+def selected_table_data(country, exp_type, value_type):
     df_country = admin_to_df_map.get(country)
-    df_col = country_type_value_to_col.get(df_country, {}).get(exp_type, {}).get(value_type)
-    if df_col and df_col in df.columns:
-        last_24 = df.tail(24)
-        if date_col and date_col in df.columns:
+    if store.country_index(df_country) >= 0:
+        last_24 = store.dates.tail(24)
+        if store.date_col:
             # Ensure date is formatted as string (e.g. '2024-07-31')
-            dates = last_24[date_col].dt.strftime('%Y-%m-%d').tolist()
+            dates = last_24.dt.strftime('%Y-%m-%d').tolist()
         else:
-            dates = [str(d) for d in last_24.index.tolist()]
-        exports = last_24[df_col].apply(lambda x: round(x, 1) if pd.notnull(x) else None).tolist()
-        selected_table_source.data = dict(
+            dates = [str(d) for d in last_24.tolist()]
+        exports = round_or_none(store.series(df_country, exp_type, value_type)[-24:])
+        return dict(
             index=list(range(len(dates))),
             date=dates,
             exports=exports
         )
     else:
-        selected_table_source.data = dict(index=[], date=[], exports=[])
-
-select_country.on_change('value', update_selected)
-select_type.on_change('value', update_selected)
-select_value_type.on_change('value', update_selected)
-
-def update_map_type(attr, old, new):
-    exp_type = select_type.value
-    value_type = select_value_type.value
-    country_exports = {}
-    for admin_name, df_country in admin_to_df_map.items():
-        df_col = country_type_value_to_col.get(df_country, {}).get(exp_type, {}).get(value_type)
-        if df_col and df_col in df.columns:
-            country_exports[admin_name] = latest_row[df_col]
-        else:
-            country_exports[admin_name] = None
-    filtered_world["exports"] = filtered_world["ADMIN"].map(country_exports)
-    if value_type == "USD m":
-        filtered_world["exports_log"] = filtered_world["exports"].apply(
-            lambda x: np.log1p(x) if pd.notnull(x) and x > 0 else None
-        )
-    else:
-        filtered_world["exports_log"] = filtered_world["exports"]
-    filtered_world["note"] = filtered_world["exports"].apply(
-        lambda x: "No Data" if pd.isnull(x) else ""
+        return dict(index=[], date=[], exports=[])
+
+def apply_selected(data):
+    selected_table_source.data = data
+update_selected = Update(
+    lambda: (select_country.value, select_type.value, select_value_type.value),
+    selected_table_data, apply_selected,
+)
+
+def map_view_selection():
+    # Region outlines are only sent the first time a view is shown.
+    grouping = current_view()
+    with_geometry = grouping is not None and not map_source(grouping).data["xs"]
+    return current_selection() + (grouping, with_geometry)
+
+def map_type_data(exp_type, value_type, t, grouping, with_geometry):
+    result = dict(
+        selection=(exp_type, value_type, grouping),
+        map=map_columns(exp_type, value_type, t, grouping),
+        frames=frame_data(exp_type, value_type, grouping),
+        world=get_world_timeseries(exp_type, value_type),
     )
-    filtered_world.loc[filtered_world["ADMIN"] == "China", "note"] = "Exporter (no data)"
-    exports_log_min = filtered_world["exports_log"].min()
-    exports_log_max = filtered_world["exports_log"].max()
-    exports_log = filtered_world["exports_log"].values
-    filtered_world["custom_color"] = get_colors(exports_log, smooth_palette, exports_log_min, exports_log_max)
-    columns_to_keep = ['ADMIN', 'exports', 'exports_log', 'note', 'custom_color', 'geometry']
-    filtered_world_small = filtered_world[columns_to_keep]
-    geo_source.geojson = filtered_world_small.to_json()
-    p.title.text = f"Automobile Exports by Country ({exp_type}, {value_type})"
-    data_table.columns = make_data_table_columns(exp_type, value_type)
+    if with_geometry:
+        rollup = store.rollups[grouping]
+        result["geometry"] = dict(xs=list(rollup.xs), ys=list(rollup.ys), ADMIN=list(rollup.names))
+    return result
+
+def apply_map_type(result):
+    exp_type, value_type, grouping = result["selection"]
+    columns, exports_log_min, exports_log_max = result["map"]
+    frames_data, frame_range_data, frames_tags = result["frames"]
+    if "geometry" in result:
+        map_source(grouping).data = dict(result["geometry"], **columns)
+    else:
+        map_source(grouping).data.update(columns)
+    for key, renderer in map_renderers.items():
+        renderer.visible = key == grouping
+    # Top N ranks countries; region views have nothing to highlight it on.
+    for widget in (top15_button, reset_button, select_top_n, select_rank_window):
+        widget.disabled = grouping is not None
+    frames_source.data = frames_data
+    frames_source.tags = frames_tags
+    frame_range_source.data.update(frame_range_data)
+    p.title.text = map_title(exp_type, value_type, grouping)
+    data_table.columns[1].title = f"Exports ({exp_type}, {value_type})"
     color_mapper_obj.low = exports_log_min
     color_mapper_obj.high = exports_log_max
     color_bar.title = f"Exports ({exp_type}, {value_type})"
-    top15_table_source.data = dict(country=[], value=[])
-    top15_chart_source.data = dict(country=[], value=[])
-    top15_chart.x_range.factors = []
-    update_world_chart()
-select_type.on_change('value', update_map_type)
-select_value_type.on_change('value', update_map_type)
-
-def highlight_top15():
-    exp_type = select_type.value
-    value_type = select_value_type.value
-    country_exports = {}
-    for admin_name, df_country in admin_to_df_map.items():
-        df_col = country_type_value_to_col.get(df_country, {}).get(exp_type, {}).get(value_type)
-        if df_col and df_col in df.columns:
-            country_exports[admin_name] = latest_row[df_col]
-        else:
-            country_exports[admin_name] = None
-    filtered_world["exports"] = filtered_world["ADMIN"].map(country_exports)
-    if value_type == "USD m":
-        exports_log = np.log1p(filtered_world["exports"].values.astype(float))
-        exports_log[np.isnan(exports_log)] = np.nan
-        filtered_world["exports_log"] = exports_log
+    hover.tooltips = hover_tooltips(value_type)
+    clear_top15()
+    update_world_chart(exp_type, value_type, result["world"])
+update_map_type = Update(map_view_selection, map_type_data, apply_map_type)
+
+def selected_region():
+    grouping = current_view()
+    if grouping is None or not region_sources[grouping].selected.indices:
+        return grouping, None
+    return grouping, store.rollups[grouping].names[region_sources[grouping].selected.indices[0]]
+
+def region_chart_data(grouping, region, exp_type, value_type):
+    return region, exp_type, value_type, get_region_timeseries(grouping, region, exp_type, value_type)
+
+def apply_region_chart(result):
+    region, exp_type, value_type, data = result
+    if region is None:
+        region_line_chart.title.text = "Select a region on the map"
     else:
-        filtered_world["exports_log"] = filtered_world["exports"]
-    exports_log = filtered_world["exports_log"].values
-    valid_indices = np.where(~np.isnan(exports_log))[0]
-    if len(valid_indices) > 15:
-        top15_idx = valid_indices[np.argpartition(-exports_log[valid_indices], 15)[:15]]
+        region_line_chart.title.text = f"{region} Monthly Auto Exports ({exp_type}, {value_type})"
+    region_chart_source.data = data
+update_region_chart = Update(
+    lambda: selected_region() + (select_type.value, select_value_type.value),
+    region_chart_data, apply_region_chart,
+)
+
+def top_n_selection():
+    return current_selection() + (int(select_top_n.value), rank_windows[select_rank_window.value])
+
+def top15_data(exp_type, value_type, t, n, window):
+    ranking = store.rankings(exp_type, value_type, window)
+    exports = ranking.values[t]
+    if is_usd(value_type):
+        exports_log = np.log1p(exports)
     else:
-        top15_idx = valid_indices
-    top_admins = set(filtered_world.iloc[top15_idx]["ADMIN"].values)
-    colors = np.full(filtered_world.shape[0], "#dddddd", dtype=object)
-    if len(top15_idx) > 0:
-        exports_log_min = exports_log[top15_idx].min()
-        exports_log_max = exports_log[top15_idx].max()
-        norm = (exports_log[top15_idx] - exports_log_min) / (exports_log_max - exports_log_min) if exports_log_max != exports_log_min else np.zeros(len(top15_idx))
-        idx = (norm * (len(smooth_palette) - 1)).round().astype(int)
-        for i, ci in enumerate(top15_idx):
-            colors[ci] = smooth_palette[idx[i]]
-    filtered_world["custom_color"] = colors
-    columns_to_keep = ['ADMIN', 'exports', 'exports_log', 'note', 'custom_color', 'geometry']
-    filtered_world_small = filtered_world[columns_to_keep]
-    geo_source.geojson = filtered_world_small.to_json()
-    top15_data = filtered_world.iloc[top15_idx][["ADMIN", "exports"]].sort_values("exports", ascending=False)
-    top15_table_source.data = dict(
-        country=top15_data["ADMIN"].tolist(),
-        value=top15_data["exports"].tolist(),
+        exports_log = exports
+    top_idx = ranking.top(t, n)
+    colors = np.full(len(exports), "#dddddd", dtype=object)
+    if len(top_idx) > 0:
+        exports_log_min = np.nanmin(exports_log[top_idx])
+        exports_log_max = np.nanmax(exports_log[top_idx])
+        norm = (exports_log[top_idx] - exports_log_min) / (exports_log_max - exports_log_min) if exports_log_max != exports_log_min else np.zeros(len(top_idx))
+        idx = (np.nan_to_num(norm) * (len(smooth_palette) - 1)).round().astype(int)
+        colors[top_idx] = np.array(smooth_palette, dtype=object)[idx]
+    change = ranking.rank_change(t, top_idx)
+    columns = dict(exports=exports, exports_log=exports_log, note=map_notes(exports), custom_color=colors.tolist())
+    top = dict(
+        country=admin_names[top_idx].tolist(),
+        value=exports[top_idx].tolist(),
+        change=[None if np.isnan(c) else int(c) for c in change],
     )
-    top15_chart_source.data = dict(
-        country=top15_data["ADMIN"].tolist(),
-        value=top15_data["exports"].tolist(),
+    return (exp_type, value_type, n, window), columns, top
+
+def apply_top15(result):
+    (exp_type, value_type, n, window), columns, top = result
+    period = next(label for label, w in rank_windows.items() if w == window)
+    geo_source.data.update(columns)
+    hover.tooltips = hover_tooltips(value_type, window)
+    top15_source.data = top
+    top15_chart.x_range.factors = top["country"]
+    top15_chart.title.text = f"Top {n} destinations, {exp_type}, {value_type} ({period})"
+    top15_table.columns[1].title = f"Exports ({exp_type}, {value_type})"
+highlight_top15 = Update(top_n_selection, top15_data, apply_top15)
+# Whichever of a highlight and a reset was asked for last wins; a map type
+# change clears the highlight, so an older one must not come back after it.
+scheduler.supersede(highlight_top15, reset_top15)
+scheduler.supersede(reset_top15, highlight_top15)
+scheduler.supersede(update_map_type, highlight_top15)
+
+def rerank_top15():
+    # Queues a re-rank of a highlight that is shown or still being computed,
+    # unless a reset is on its way. It runs through the scheduler like the
+    # button, so an older highlight still in flight is dropped.
+    highlighted = top15_source.data["country"] or scheduler.requested(highlight_top15)
+    if highlighted and not scheduler.requested(reset_top15):
+        scheduler.request(highlight_top15, debounce=False)
+
+def update_top_n():
+    top15_button.label = f"Highlight Top {select_top_n.value}"
+    rerank_top15()
+
+def update_month():
+    # The browser already recolored the map; re-rank an active highlight for
+    # the new month (a slice of the precomputed rankings).
+    rerank_top15()
+
+# --- DATA RELOAD ---
+# The server swaps in a new store when the CSV changes (datastore.reload).
+# Each session switches to it in one held document callback: appended months
+# are streamed to the time series and the month slider data, and the map is
+# recolored only if it shows the latest month. Anything else refreshes every
+# view from the new store. Updates computed against the old store are dropped
+# and run again.
+def apply_reload(new_store):
+    global store, export_types, value_types, admin_to_df_map, admin_names, exporter_rows
+    global month_labels, latest_month
+    old_store, old_latest = store, latest_month
+    if new_store is old_store:
+        return
+    store = new_store
+    export_types = store.export_types
+    value_types = store.value_type_options
+    admin_to_df_map = store.admin_to_df_map
+    admin_names = store.world["ADMIN"].to_numpy()
+    exporter_rows = np.flatnonzero(admin_names == "China")
+    month_labels = store.dates.dt.strftime('%b-%y').tolist() if store.date_col else [str(d) for d in store.dates]
+    latest_month = len(store.dates) - 1
+    scheduler.invalidate()
+    with instrumentation.recording(doc):
+        doc.hold('combine')
+        try:
+            if store.appended_from == old_latest + 1:
+                stream_appended_months(old_latest + 1)
+            else:
+                refresh_all()
+        finally:
+            doc.unhold()
+
+def stream_appended_months(start):
+    exp_type, value_type, t = current_selection()
+    grouping = current_view()
+    new_dates = store.dates.iloc[start:].tolist()
+    if store.country_index(world_country) >= 0:
+        world_chart_source.stream(dict(
+            date=new_dates, value=round_or_none(store.series(world_country, exp_type, value_type)[start:]),
+        ))
+    frames = store.frames(exp_type, value_type, len(smooth_palette), grouping)
+    frames_source.stream(dict(
+        exports=frames.values32[start:].ravel(), color_idx=frames.color_idx[start:].ravel(),
+    ))
+    frame_range_source.stream(dict(
+        label=month_labels[start:], date=new_dates, low=frames.low[start:], high=frames.high[start:],
+    ))
+    table = selected_table_source.data
+    if table["index"]:
+        new_rows = selected_table_data(select_country.value, exp_type, value_type)
+        n_new = len(store.dates) - start
+        selected_table_source.stream(dict(
+            index=list(range(table["index"][-1] + 1, table["index"][-1] + 1 + n_new)),
+            date=new_rows["date"][-n_new:], exports=new_rows["exports"][-n_new:],
+        ), rollover=24)
+    if region_chart_source.data["date"]:
+        grouping, region = selected_region()
+        if region is not None:
+            region_chart_source.stream(dict(
+                date=new_dates,
+                value=round_or_none(store.rollups[grouping].series(region, exp_type, value_type)[start:]),
+            ))
+    month_slider.end = latest_month
+    if t == start - 1:
+        # Follow the data to the new latest month; only colors and values change.
+        columns, low, high = map_columns(exp_type, value_type, latest_month, grouping)
+        map_source(grouping).data.update(columns)
+        color_mapper_obj.low = low
+        color_mapper_obj.high = high
+        month_slider.value = latest_month
+        month_slider.title = f"Month: {month_labels[latest_month]}"
+        month_span.location = store.dates.iloc[latest_month]
+        rerank_top15()
+
+def refresh_all():
+    global map_level
+    select_type.options = export_types
+    select_value_type.options = value_types
+    if select_type.value not in export_types:
+        select_type.value = DEFAULT_TYPE
+    if select_value_type.value not in value_types:
+        select_value_type.value = DEFAULT_VALUE_TYPE
+    select_country.options = sorted(list(admin_to_df_map.keys()))
+    month_slider.end = latest_month
+    month_slider.value = min(month_slider.value, latest_month)
+    month_slider.title = f"Month: {month_labels[month_slider.value]}"
+    month_span.location = store.dates.iloc[month_slider.value]
+    exp_type, value_type, t = current_selection()
+    geo_source.data = dict(
+        xs=list(store.lod_xs[0]), ys=list(store.lod_ys[0]), ADMIN=admin_names.tolist(),
+        **map_columns(exp_type, value_type, t)[0],
     )
-    top15_chart.x_range.factors = top15_data["ADMIN"].tolist()
-top15_button.on_click(highlight_top15)
+    map_level = np.zeros(len(admin_names), dtype=int)
+    for source in region_sources.values():
+        source.selected.indices = []
+        source.data = {key: [] for key in source.data}
+    frames = store.frames(exp_type, value_type, len(smooth_palette))
+    frame_range_source.data = dict(label=month_labels, date=store.dates.tolist(), low=frames.low, high=frames.high)
+    apply_map_type(map_type_data(*map_view_selection()))
+    apply_selected(selected_table_data(select_country.value, select_type.value, select_value_type.value))
+    apply_region_chart(region_chart_data(*selected_region(), select_type.value, select_value_type.value))
+
+def on_store_reloaded(new_store):
+    # Called from the reloading thread; the switch runs on the session's loop.
+    doc.add_next_tick_callback(lambda: apply_reload(new_store))
+
+doc = curdoc()
+subscribe(on_store_reloaded)
+doc.on_session_destroyed(lambda session_context: unsubscribe(on_store_reloaded))
+if get_store() is not store:
+    # A reload finished while this session was being built.
+    on_store_reloaded(get_store())
+
+scheduler.on_change(select_country, 'value', update_selected)
+scheduler.on_change(select_type, 'value', update_map_type, update_selected, update_region_chart)
+scheduler.on_change(select_value_type, 'value', update_map_type, update_selected, update_region_chart)
+scheduler.on_change(select_map_view, 'value', update_map_type, update_region_chart)
+for source in region_sources.values():
+    scheduler.on_change(source.selected, 'indices', update_region_chart)
+scheduler.on_change(month_slider, 'value', update_month)
+scheduler.on_change(select_top_n, 'value', update_top_n)
+scheduler.on_change(select_rank_window, 'value', update_top_n)
+scheduler.on_click(top15_button, highlight_top15)
 
 style = """
 <style>
@@ -472,14 +707,19 @@ style = """
 </style>
 """
 style_div = Div(text=style)
-top_selectors_row = row(select_type, select_value_type, sizing_mode="fixed")
+top_selectors_row = row(select_type, select_value_type, select_map_view, sizing_mode="fixed")
+charts_row = row(world_line_chart, region_line_chart, sizing_mode="fixed")
+month_row = row(play_button, month_slider, sizing_mode="fixed")
 bottom_selector_row = row(select_country, sizing_mode="fixed")
 top15_buttons_row = row(top15_button, reset_button, sizing_mode="fixed")
+top15_options_row = row(select_top_n, select_rank_window, sizing_mode="fixed")
 
 top15_col = column(
-    top15_buttons_row,            # includes top15_button, reset_button, download_top15_button
+    top15_buttons_row,            # includes top15_button, reset_button
+    top15_options_row,
     top15_chart,
     top15_table,
+    download_top15_button,
     sizing_mode="fixed",
     width=370
 )
@@ -494,13 +734,15 @@ main_row = row(
 bottom_selector_row = row(
     select_country,
     download_timeseries_button,
+    select_export_format,
     sizing_mode="fixed"
 )
 
 layout = column(
     style_div,
     top_selectors_row,
-    world_line_chart,
+    charts_row,
+    month_row,
     main_row,
     bottom_selector_row,          # includes country select and download_timeseries_button
     data_table,
@@ -510,4 +752,5 @@ layout = column(
 
 
 curdoc().add_root(layout)
-curdoc().title = "China, Auto Exports"
\ No newline at end of file
+curdoc().title = "China, Auto Exports"
+instrumentation.session_created(doc, time.perf_counter() - session_started)
\ No newline at end of file
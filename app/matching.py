@@ -0,0 +1,113 @@
+import difflib
+import hashlib
+import json
+import os
+import re
+import unicodedata
+
+import pandas as pd
+
+# Deterministic matching of CSV series names to shapefile countries:
+#   1. curated aliases (data/country_aliases.csv),
+#   2. exact lookup on normalized shapefile names (ADMIN first, then the
+#      other English name attributes),
+#   3. difflib only as a fallback for whatever is still unmatched.
+# "(Before 2023)"/"(Since 2023)" splits and duplicate spellings resolve to
+# the same country and are merged into one series group. The result is
+# cached on disk and rebuilt only when its inputs change.
+
+# Shapefile attributes searched for exact matches, in priority order.
+NAME_COLUMNS = ['ADMIN', 'NAME', 'NAME_LONG', 'BRK_NAME', 'FORMAL_EN', 'NAME_EN',
+                'NAME_CIAWF', 'NAME_SORT', 'NAME_ALT', 'GEOUNIT', 'SUBUNIT']
+FUZZY_CUTOFF = 0.85
+
+PERIOD_SPLIT = re.compile(r'^(.*?)\s*\((?:Before|Since) \d{4}\)$')
+
+
+def normalize(name):
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode()
+    name = name.lower().replace('&', ' and ')
+    name = re.sub(r'^the ', '', name)
+    return re.sub(r'[^a-z0-9]', '', name)
+
+
+def base_name(series):
+    m = PERIOD_SPLIT.match(series)
+    return m.group(1) if m else series
+
+
+def read_aliases(path):
+    if not os.path.exists(path):
+        return {}
+    aliases = pd.read_csv(path, dtype=str, keep_default_na=False)
+    return dict(zip(aliases['series'], aliases['admin']))
+
+
+def match_countries(series_names, names, aliases):
+    # series_names: CSV series (country) names; names: shapefile DataFrame
+    # with ADMIN and any of NAME_COLUMNS. Returns (admin_to_country,
+    # country_series): shapefile ADMIN -> canonical country, and canonical
+    # country -> list of series names to merge.
+    lookup = {}
+    for col in NAME_COLUMNS:
+        if col not in names.columns:
+            continue
+        for admin, value in zip(names['ADMIN'], names[col]):
+            if isinstance(value, str) and value:
+                lookup.setdefault(normalize(value), admin)
+
+    country_series = {}
+    unmatched = {}
+    for series in series_names:
+        base = base_name(series)
+        admin = aliases.get(base) or aliases.get(series) or lookup.get(normalize(base))
+        if admin:
+            country_series.setdefault(admin, []).append(series)
+        else:
+            unmatched.setdefault(normalize(base), []).append(series)
+
+    # Fuzzy fallback, restricted to countries nothing else has claimed.
+    claimed = set(country_series)
+    free_keys = {k: a for k, a in lookup.items() if a not in claimed}
+    for key, group in unmatched.items():
+        match = difflib.get_close_matches(key, list(free_keys), n=1, cutoff=FUZZY_CUTOFF) if key else []
+        if match:
+            admin = free_keys[match[0]]
+            country_series.setdefault(admin, []).extend(group)
+            free_keys = {k: a for k, a in free_keys.items() if a != admin}
+        else:
+            country_series[base_name(group[0])] = group
+
+    admins = set(names['ADMIN'])
+    admin_to_country = {a: a for a in country_series if a in admins}
+    return admin_to_country, country_series
+
+
+def _mapping_key(series_names, names, aliases):
+    h = hashlib.sha256()
+    h.update(json.dumps([list(series_names), names.astype(str).values.tolist(), sorted(aliases.items())]).encode())
+    return h.hexdigest()
+
+
+def load_mapping(series_names, names, path, aliases_path):
+    names = names[[c for c in NAME_COLUMNS if c in names.columns]]
+    aliases = read_aliases(aliases_path)
+    key = _mapping_key(series_names, names, aliases)
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        if cached.get('key') == key:
+            return cached['admin_to_country'], cached['country_series']
+    except (OSError, ValueError):
+        pass
+
+    admin_to_country, country_series = match_countries(series_names, names, aliases)
+    try:
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(key=key, admin_to_country=admin_to_country, country_series=country_series), f, indent=1)
+        os.replace(tmp_path, path)
+    except OSError:
+        # A read-only deploy still works, it just re-matches on each start.
+        pass
+    return admin_to_country, country_series
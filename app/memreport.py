@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import instrumentation
+
+# Resident memory of one server worker, loaded with the full and the lean
+# data profile (see datastore.load):
+#
+#   python app/memreport.py [--sessions 4] [--json]
+#
+# Each profile runs in a fresh interpreter, so the numbers do not mix. RSS is
+# taken before loading, after loading the shared store and after building
+# `--sessions` documents, which is what a worker holds with that many open
+# sessions, along with the peak while loading. The sizes of the main store
+# arrays are listed alongside.
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+PROFILES = ('full', 'lean')
+
+
+def peak_rss_mb():
+    return instrumentation.peak_rss_bytes() / 2**20
+
+
+def rss_mb():
+    # Current resident set size; the peak where /proc is not available.
+    rss = instrumentation.rss_bytes()
+    return peak_rss_mb() if rss is None else rss / 2**20
+
+
+def store_sizes(store):
+    coords = sum(a.nbytes for level in store.lod_xs + store.lod_ys for a in level)
+    return dict(
+        cube_mb=store.cube.nbytes / 2**20,
+        cube_dtype=str(store.cube.dtype),
+        rollups_mb=sum(r.cube.nbytes for r in store.rollups.values()) / 2**20,
+        geometry_mb=coords / 2**20,
+        countries=len(store.countries),
+    )
+
+
+def measure(profile, sessions):
+    # Runs in the child process.
+    sys.path.insert(0, APP_DIR)
+    from bokeh.application import Application
+    from bokeh.application.handlers.directory import DirectoryHandler
+
+    import datastore
+
+    result = dict(profile=profile, start_mb=rss_mb())
+    datastore._store = datastore.load(lean=profile == 'lean')
+    result['loaded_mb'] = rss_mb()
+    result['load_peak_mb'] = peak_rss_mb()
+    app = Application(DirectoryHandler(filename=APP_DIR))
+    docs = [app.create_document() for _ in range(sessions)]
+    result['sessions'] = len(docs)
+    result['sessions_mb'] = rss_mb()
+    result['per_session_mb'] = (result['sessions_mb'] - result['loaded_mb']) / max(len(docs), 1)
+    result.update(store_sizes(datastore._store))
+    return result
+
+
+def run_profile(profile, sessions):
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', profile, '--sessions', str(sessions)],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare worker memory of the full and lean data loads.")
+    parser.add_argument('--sessions', type=int, default=4)
+    parser.add_argument('--json', action='store_true', help="print machine-readable results")
+    parser.add_argument('--child', choices=PROFILES, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child:
+        print(json.dumps(measure(args.child, args.sessions)))
+        return
+    results = [run_profile(profile, args.sessions) for profile in PROFILES]
+    if args.json:
+        print(json.dumps(results, indent=1))
+        return
+    rows = [
+        ('RSS before load (MB)', 'start_mb'),
+        ('RSS after load (MB)', 'loaded_mb'),
+        ('peak RSS while loading (MB)', 'load_peak_mb'),
+        (f'RSS with {args.sessions} sessions (MB)', 'sessions_mb'),
+        ('per session (MB)', 'per_session_mb'),
+        ('cube (MB)', 'cube_mb'),
+        ('cube dtype', 'cube_dtype'),
+        ('region rollups (MB)', 'rollups_mb'),
+        ('map coordinates (MB)', 'geometry_mb'),
+        ('cube countries', 'countries'),
+    ]
+    print(f"{'':32}" + ''.join(f'{r["profile"]:>12}' for r in results))
+    for label, key in rows:
+        cells = [r[key] for r in results]
+        print(f'{label:32}' + ''.join(f'{c:>12.1f}' if isinstance(c, float) else f'{c:>12}' for c in cells))
+    full, lean = results
+    print(f"\nlean saves {full['sessions_mb'] - lean['sessions_mb']:.1f} MB per worker "
+          f"({full['loaded_mb'] - full['start_mb']:.1f} -> {lean['loaded_mb'] - lean['start_mb']:.1f} MB for the store)")
+
+
+if __name__ == '__main__':
+    main()
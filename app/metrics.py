@@ -0,0 +1,101 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Derived value types, computed from the raw USD columns of the cube for
+# every country at once and offered next to the raw value types. Each maps
+# to (metric, window): trailing sums over `window` months, growth against
+# the same month `window` months earlier, and the share of the export type
+# in the country's Total.
+
+BASE_VALUE_TYPE = 'USD m'
+TOTAL_TYPE = 'Total'
+
+DERIVED = {
+    'USD m, 3-month sum': ('rolling_sum', 3),
+    'USD m, 12-month sum': ('rolling_sum', 12),
+    'YoY growth %': ('yoy', 12),
+    'Share of Total %': ('share', 1),
+}
+
+# Entries are (date x country) float arrays, a few hundred kB each.
+DEFAULT_CACHE_SIZE = 64
+
+
+def is_usd(value_type):
+    # USD amounts are colored and ranked on a log scale and summed over
+    # windows; percentages are linear and averaged.
+    return value_type == BASE_VALUE_TYPE or DERIVED.get(value_type, (None, None))[0] == 'rolling_sum'
+
+
+def trailing(block, window, mean=False):
+    # Trailing `window`-month sum (or mean, for shares) of a (date x country)
+    # block. Months missing inside a window are skipped; the first
+    # window - 1 months, and windows without any data, are NaN.
+    if window <= 1:
+        return block
+    out = np.full(block.shape, np.nan, dtype=block.dtype)
+    if len(block) < window:
+        return out
+    windows = np.lib.stride_tricks.sliding_window_view(block, window, axis=0)
+    counts = np.count_nonzero(~np.isnan(windows), axis=-1)
+    total = np.nansum(windows, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out[window - 1:] = np.where(counts > 0, total / counts if mean else total, np.nan)
+    return out
+
+
+def growth(block, lag):
+    # Percent change against `lag` months earlier; NaN without a positive base.
+    out = np.full(block.shape, np.nan, dtype=block.dtype)
+    if len(block) <= lag:
+        return out
+    prior = block[:-lag]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out[lag:] = np.where(prior > 0, (block[lag:] / prior - 1) * 100, np.nan)
+    return out
+
+
+def share(block, total):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(total > 0, block / total * 100, np.nan)
+
+
+class MetricCache:
+    # Lazily computed derived blocks, shared by every session of the process
+    # and bounded to the `maxsize` most recently used (metric, export type,
+    # window) keys. `raw_block(exp_type, value_type)` reads the cube.
+    def __init__(self, raw_block, maxsize=DEFAULT_CACHE_SIZE):
+        self._raw_block = raw_block
+        self._maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, value_type, exp_type):
+        metric, window = DERIVED[value_type]
+        key = (metric, exp_type, window)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        # Computed outside the lock; concurrent misses on one key just
+        # compute the same block twice.
+        values = self._compute(metric, exp_type, window)
+        values.flags.writeable = False
+        with self._lock:
+            self._cache[key] = values
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._maxsize:
+                self._cache.popitem(last=False)
+        return values
+
+    def _compute(self, metric, exp_type, window):
+        usd = self._raw_block(exp_type, BASE_VALUE_TYPE)
+        if metric == 'rolling_sum':
+            return trailing(usd, window)
+        if metric == 'yoy':
+            return growth(usd, window)
+        if metric == 'share':
+            return share(usd, self._raw_block(TOTAL_TYPE, BASE_VALUE_TYPE))
+        raise ValueError(f"unknown metric {metric!r}")
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bokeh.document import without_document_lock
+
+import instrumentation
+
+log = logging.getLogger(__name__)
+
+# Coalesces the updates triggered by widget events into one recompute per
+# interaction. Every update requested before the flush runs exactly once,
+# in request order, and all of them are applied inside a single document
+# hold, so the resulting model changes are combined and written to the
+# client in one burst. Repeated widget changes within `delay_ms` (e.g.
+# arrowing through a Select) keep pushing the flush back, so only the latest
+# state is applied.
+#
+# Bokeh's server protocol sends one PATCH-DOC message per combined event;
+# holding the document is the batching point it exposes.
+#
+# Expensive work is split off into `Update.compute`, which runs in a worker
+# pool shared by every session of the process without holding the document
+# lock, so one session's recompute does not stall the others. Results come
+# back on the next tick; results of a superseded request are cancelled if
+# not yet started, and dropped otherwise. A request supersedes the earlier
+# ones of the same update and of the updates registered with `supersede`.
+#
+# With instrumentation enabled, handlers, compute and apply times, the
+# latency from the first request to the applied result and the size of each
+# combined update are recorded (see instrumentation.py).
+
+DEFAULT_DELAY_MS = 150
+
+# One pool per server process.
+executor = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='update')
+
+
+class Update:
+    # `prepare` runs on the document thread and captures widget state as a
+    # tuple of arguments; `compute(*args)` runs in the worker pool and must
+    # not touch the document; `apply(result)` runs back on the document
+    # thread. `name` labels its metrics; by default the name of `apply`
+    # without the apply_ prefix.
+    def __init__(self, prepare, compute, apply, name=None):
+        self.prepare = prepare
+        self.compute = compute
+        self.apply = apply
+        self.name = name or apply.__name__.removeprefix('apply_')
+
+
+def update_name(update):
+    return update.name if isinstance(update, Update) else update.__name__
+
+
+class UpdateScheduler:
+    def __init__(self, doc, delay_ms=DEFAULT_DELAY_MS):
+        self._doc = doc
+        self._delay_ms = delay_ms
+        self._pending = {}
+        self._callback = None
+        self._debounced = False
+        self._tokens = {}
+        self._futures = {}
+        self._inflight = {}
+        self._supersedes = {}
+
+    def request(self, *updates, debounce=True):
+        now = time.perf_counter()
+        for update in updates:
+            self._pending.setdefault(update, now)
+        if self._callback is not None:
+            # A queued immediate flush picks these up as well; a debounced
+            # one is pushed back (or brought forward for an immediate request).
+            if not self._debounced:
+                return
+            self._doc.remove_timeout_callback(self._callback)
+        if debounce:
+            self._callback = self._doc.add_timeout_callback(self._run, self._delay_ms)
+        else:
+            self._callback = self._doc.add_next_tick_callback(self._run)
+        self._debounced = debounce
+
+    def requested(self, update):
+        # Whether `update` is queued or running and not yet applied.
+        return update in self._pending or update in self._inflight
+
+    def supersede(self, update, *others):
+        # Starting `update` drops the results of `others` requested before
+        # it and still in flight, e.g. a reset over an older highlight.
+        self._supersedes.setdefault(update, []).extend(others)
+
+    def on_change(self, model, attr, *updates):
+        model.on_change(attr, instrumentation.timed_handler(
+            f'{model.name or type(model).__name__}.{attr}', lambda attr, old, new: self.request(*updates)))
+
+    def on_click(self, button, *updates):
+        button.on_click(instrumentation.timed_handler(
+            f'{button.name or type(button).__name__}.click', lambda: self.request(*updates, debounce=False)))
+
+    def invalidate(self):
+        # The data the running updates read has been replaced: drop their
+        # results and run them again.
+        stale = list(self._inflight)
+        for update in stale:
+            self._drop(update)
+        if stale:
+            self.request(*stale, debounce=False)
+
+    def _drop(self, update):
+        # Ignore the result of `update`'s running request.
+        if update in self._inflight:
+            self._tokens[update] += 1
+            del self._inflight[update]
+        future = self._futures.pop(update, None)
+        if future is not None:
+            future.cancel()
+
+    def _run(self):
+        self._callback = None
+        requested = dict(self._pending)
+        self._pending.clear()
+        if not requested:
+            return
+        jobs = []
+        for update, requested_at in requested.items():
+            token = self._tokens[update] = self._tokens.get(update, 0) + 1
+            self._inflight[update] = token
+            superseded = self._futures.pop(update, None)
+            if superseded is not None:
+                superseded.cancel()
+            for other in self._supersedes.get(update, ()):
+                self._drop(other)
+            args = update.prepare() if isinstance(update, Update) else None
+            jobs.append((update, token, args, requested_at))
+
+        if not any(isinstance(update, Update) for update, _, _, _ in jobs):
+            self._apply(jobs, [None] * len(jobs))
+            return
+
+        @without_document_lock
+        async def compute():
+            loop = asyncio.get_running_loop()
+            futures = []
+            for update, _, args, _ in jobs:
+                if isinstance(update, Update):
+                    compute = update.compute
+                    if instrumentation.enabled:
+                        compute = instrumentation.timed_compute(update_name(update), compute)
+                    future = loop.run_in_executor(executor, compute, *args)
+                    self._futures[update] = future
+                else:
+                    future = loop.create_future()
+                    future.set_result(None)
+                futures.append(future)
+            results = await asyncio.gather(*futures, return_exceptions=True)
+            for (update, _, _, _), future in zip(jobs, futures):
+                if self._futures.get(update) is future:
+                    del self._futures[update]
+            self._doc.add_next_tick_callback(lambda: self._apply(jobs, results))
+        self._doc.add_next_tick_callback(compute)
+
+    def _apply(self, jobs, results):
+        measured = instrumentation.enabled
+        with instrumentation.recording(self._doc):
+            self._doc.hold('combine')
+            try:
+                for (update, token, _, requested_at), result in zip(jobs, results):
+                    if self._tokens.get(update) != token or isinstance(result, asyncio.CancelledError):
+                        continue
+                    del self._inflight[update]
+                    if isinstance(result, BaseException):
+                        log.error("update %r failed", update, exc_info=result)
+                        if measured:
+                            instrumentation.count_error(update_name(update))
+                        continue
+                    start = time.perf_counter() if measured else None
+                    if isinstance(update, Update):
+                        update.apply(result)
+                    else:
+                        update()
+                    if measured:
+                        end = time.perf_counter()
+                        instrumentation.observe_update(update_name(update), 'apply', end - start)
+                        instrumentation.observe_update(update_name(update), 'total', end - requested_at)
+            finally:
+                self._doc.unhold()
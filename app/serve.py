@@ -0,0 +1,78 @@
+import argparse
+import logging
+import os
+
+from bokeh.application import Application
+from bokeh.application.handlers.directory import DirectoryHandler
+from bokeh.server.server import Server
+
+import datastore
+import instrumentation
+import sharedstore
+from export import EXPORT_PATH, ExportHandler
+
+# Runs the app the way `bokeh serve app` does, plus the plain HTTP handlers
+# served next to it, which `bokeh serve` has no option for:
+#
+#   python app/serve.py --port=5006 --allow-websocket-origin=localhost:5006
+#
+# The app stays at /app; the export endpoint is at /export, and with
+# --metrics the Prometheus metrics are at /metrics (see instrumentation.py).
+#
+# With --num-procs other than 1 (or --shared-dir), the data is loaded once,
+# here, before the workers are forked, and published as a shared store (see
+# sharedstore.py) that every worker maps instead of loading its own copy.
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = '/app'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the auto exports app and its HTTP endpoints.")
+    parser.add_argument('--port', type=int, default=5006)
+    parser.add_argument('--address', default=None)
+    parser.add_argument('--allow-websocket-origin', action='append', default=[])
+    parser.add_argument('--use-xheaders', action='store_true')
+    parser.add_argument('--num-procs', type=int, default=1,
+                        help="worker processes sharing the port (0: one per CPU)")
+    parser.add_argument('--shared-dir', default=None,
+                        help="directory of the shared store (default: one per port under /dev/shm)")
+    parser.add_argument('--metrics', action='store_true', help="record runtime metrics and serve them at /metrics")
+    parser.add_argument('--metrics-log-interval', type=float, default=None, metavar='SECONDS',
+                        help="also log a metrics summary this often (implies --metrics)")
+    return parser.parse_args(argv)
+
+
+def extra_patterns():
+    patterns = [(EXPORT_PATH, ExportHandler)]
+    if instrumentation.enabled:
+        patterns.append((instrumentation.METRICS_PATH, instrumentation.MetricsHandler))
+    return patterns
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    instrumentation.configure(args.metrics or None, args.metrics_log_interval)
+    if args.num_procs != 1 or args.shared_dir:
+        directory = args.shared_dir or sharedstore.default_dir(args.port)
+        sharedstore.clear(directory)
+        datastore.share(directory)
+        datastore.publish(datastore.load)
+        logging.info("Shared store published in %s", directory)
+    server = Server(
+        {APP_PATH: Application(DirectoryHandler(filename=APP_DIR))},
+        port=args.port,
+        address=args.address,
+        allow_websocket_origin=args.allow_websocket_origin or None,
+        use_xheaders=args.use_xheaders,
+        num_procs=args.num_procs,
+        extra_patterns=extra_patterns(),
+    )
+    server.start()
+    logging.info("Bokeh app running at: http://%s:%d%s", args.address or 'localhost', server.port, APP_PATH)
+    server.io_loop.start()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+import logging
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+import datastore
+import instrumentation
+
+log = logging.getLogger(__name__)
+
+# How often the CSV is checked for new rows. A check is one stat() unless
+# the file changed.
+RELOAD_INTERVAL_MS = 60_000
+
+
+async def check_for_reload():
+    # Parsing and building the new store happen off the IO loop; sessions
+    # pick the new store up through datastore.subscribe.
+    try:
+        store = await IOLoop.current().run_in_executor(None, datastore.reload)
+    except Exception:
+        log.exception("reloading %s failed", datastore.CSV_PATH)
+        return
+    if store is not None:
+        how = f"{len(store.dates) - store.appended_from} appended months" if store.appended_from is not None else "full reload"
+        log.info("reloaded %s (%s)", datastore.CSV_PATH, how)
+
+
+def on_server_loaded(server_context):
+    # Load the shapefile, CSV and country matching once per process, before
+    # the first session arrives, instead of once per session.
+    datastore.get_store()
+    PeriodicCallback(check_for_reload, RELOAD_INTERVAL_MS).start()
+    if instrumentation.enabled and instrumentation.log_interval_s > 0:
+        PeriodicCallback(instrumentation.LogReporter(), instrumentation.log_interval_s * 1000).start()
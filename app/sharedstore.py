@@ -0,0 +1,150 @@
+import contextlib
+import fcntl
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+# The data store in files that every worker process maps, so that workers
+# add CPU without each holding their own copy of the cube and the map
+# geometry:
+#   <dir>/<generation>/store.pickle  the store, minus its large arrays
+#   <dir>/<generation>/<n>.npy       each array of MIN_SHARED_BYTES or more
+#   <dir>/current                    name of the published generation
+# A generation is written under a temporary name and renamed into place;
+# `current` is replaced last and acts as the commit marker, as in
+# csvcache.py, so a reader never sees a half-written store. Readers map the
+# arrays read-only (np.load mmap_mode='r'): their pages are shared through
+# the page cache, and they stay valid after a generation is deleted. Put the
+# directory on tmpfs (/dev/shm) to keep the pages off disk.
+#
+# The store classes decide what is written through __getstate__ (see
+# datastore.py); per-process caches are rebuilt empty on attach.
+
+CURRENT = 'current'
+PICKLE = 'store.pickle'
+LOCK = 'build.lock'
+MIN_SHARED_BYTES = 64 * 1024
+KEEP_GENERATIONS = 2
+ATTACH_ATTEMPTS = 3
+BASE_DIR = '/dev/shm' if os.access('/dev/shm', os.W_OK) else tempfile.gettempdir()
+
+
+def default_dir(port):
+    # One directory per server port, so a restart replaces its own files.
+    return os.path.join(BASE_DIR, f'auto-exports-{port}')
+
+
+def clear(directory):
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory, exist_ok=True)
+
+
+class _Pickler(pickle.Pickler):
+    # Writes large arrays to their own .npy file; an array referenced twice
+    # is written once.
+    def __init__(self, f, directory):
+        super().__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._directory = directory
+        self._written = {}
+        self._keep = []
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, np.ndarray) or obj.dtype.hasobject or obj.nbytes < MIN_SHARED_BYTES:
+            return None
+        name = self._written.get(id(obj))
+        if name is None:
+            name = self._written[id(obj)] = f'{len(self._written)}.npy'
+            self._keep.append(obj)
+            np.save(os.path.join(self._directory, name), np.ascontiguousarray(obj))
+        return name
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, f, directory):
+        super().__init__(f)
+        self._directory = directory
+
+    def persistent_load(self, name):
+        # A plain read-only ndarray over the mapping; the views taken from
+        # it keep the mapping alive.
+        return np.load(os.path.join(self._directory, name), mmap_mode='r').view(np.ndarray)
+
+
+def publish(directory, store):
+    # Writes `store` as a new generation and makes it current. Returns the
+    # generation name.
+    os.makedirs(directory, exist_ok=True)
+    generation = f'{time.time_ns()}-{os.getpid()}'
+    tmp = os.path.join(directory, f'.{generation}.tmp')
+    os.mkdir(tmp)
+    try:
+        with open(os.path.join(tmp, PICKLE), 'wb') as f:
+            _Pickler(f, tmp).dump(store)
+        os.rename(tmp, os.path.join(directory, generation))
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    tmp_current = os.path.join(directory, f'{CURRENT}.{os.getpid()}.tmp')
+    with open(tmp_current, 'w') as f:
+        f.write(generation)
+    os.replace(tmp_current, os.path.join(directory, CURRENT))
+    _prune(directory, generation)
+    return generation
+
+
+def _prune(directory, current):
+    # Keep the newest generations; workers still on an older one keep their
+    # mappings of its deleted files.
+    generations = sorted((name for name in os.listdir(directory) if name[0].isdigit()),
+                         key=lambda name: int(name.split('-')[0]))
+    for name in generations[:-KEEP_GENERATIONS]:
+        if name != current:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def current(directory):
+    # Name of the published generation, or None.
+    try:
+        with open(os.path.join(directory, CURRENT)) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def attach(directory):
+    # The current generation's store with its arrays mapped, or None if none
+    # is published. Retries when the generation is pruned while being read.
+    for _ in range(ATTACH_ATTEMPTS):
+        generation = current(directory)
+        if generation is None:
+            return None
+        path = os.path.join(directory, generation)
+        try:
+            with open(os.path.join(path, PICKLE), 'rb') as f:
+                store = _Unpickler(f, path).load()
+        except FileNotFoundError:
+            continue
+        store.generation = generation
+        return store
+    return None
+
+
+@contextlib.contextmanager
+def build_lock(directory, blocking=True):
+    # Held by the one process building a new generation. Yields whether the
+    # lock was taken; without `blocking`, it is not waited for.
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, LOCK), 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
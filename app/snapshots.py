@@ -0,0 +1,226 @@
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from bokeh.embed import file_html, json_item
+from bokeh.layouts import column, row
+from bokeh.models import (
+    ColorBar, ColumnDataSource, DataTable, DatetimeTickFormatter, HoverTool, LinearColorMapper,
+    NumberFormatter, NumeralTickFormatter, TableColumn,
+)
+from bokeh.plotting import figure
+from bokeh.resources import CDN
+from bokeh.themes import Theme
+
+import datastore
+from styling import smooth_palette, theme_json
+
+# Static snapshots of the map, the world chart and the Top 15 panel for
+# every (export type, value type, month), rendered without a server:
+#
+#   python app/snapshots.py --out snapshots [--workers 4] [--type Electric]
+#
+# Each combination is written as <out>/<type>/<value type>/<YYYY-MM>.html
+# (standalone page) and .json (Bokeh json_item). The data is loaded once;
+# worker processes are forked from the loaded parent and share it. A
+# manifest of per-snapshot digests of the data each one shows makes reruns
+# incremental: only snapshots whose inputs changed are rendered again.
+
+RENDER_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+TOP_N = 15
+
+log = logging.getLogger(__name__)
+
+
+def slug(text):
+    return re.sub(r'[^A-Za-z0-9]+', '-', text).strip('-').lower() or 'x'
+
+
+def month_label(store, t):
+    return store.dates.iloc[t].strftime('%Y-%m') if store.date_col else str(store.dates.iloc[t])
+
+
+def snapshot_paths(out_dir, store, exp_type, value_type, t):
+    stem = os.path.join(out_dir, slug(exp_type), slug(value_type), month_label(store, t))
+    return f'{stem}.html', f'{stem}.json'
+
+
+def _geometry_digest(store):
+    h = hashlib.sha256(store.world['ADMIN'].str.cat(sep='|').encode())
+    for xs, ys in zip(store.lod_xs[0], store.lod_ys[0]):
+        h.update(xs.tobytes())
+        h.update(ys.tobytes())
+    return h.hexdigest()
+
+
+def snapshot_digest(store, geometry_digest, exp_type, value_type, t):
+    # Everything a snapshot shows: the month's map values, the world series
+    # up to that month and the named shapes. Later months do not affect it.
+    frames = store.frames(exp_type, value_type, len(smooth_palette))
+    h = hashlib.sha256(f'{RENDER_VERSION}|{geometry_digest}|{exp_type}|{value_type}|{month_label(store, t)}'.encode())
+    h.update(np.ascontiguousarray(frames.values[t]).tobytes())
+    if store.country_index(datastore.WORLD_COUNTRY) >= 0:
+        h.update(np.ascontiguousarray(store.series(datastore.WORLD_COUNTRY, exp_type, value_type)[:t + 1]).tobytes())
+    return h.hexdigest()
+
+
+def build_layout(store, exp_type, value_type, t):
+    frames = store.frames(exp_type, value_type, len(smooth_palette))
+    admin = store.world['ADMIN'].to_numpy()
+    colors = np.array(smooth_palette + ['#dddddd'], dtype=object)[np.minimum(frames.color_idx[t], len(smooth_palette))]
+    label = month_label(store, t)
+    title = f"{exp_type}, {value_type}, {label}"
+
+    map_source = ColumnDataSource(data=dict(
+        xs=list(store.lod_xs[0]), ys=list(store.lod_ys[0]), ADMIN=admin.tolist(),
+        exports=frames.values[t], custom_color=colors.tolist(),
+    ))
+    p = figure(title=f"China, Auto exports by country, {title}", tools="pan,wheel_zoom,reset,save",
+               x_axis_location=None, y_axis_location=None, width=950, height=520)
+    p.grid.grid_line_color = None
+    p.patches('xs', 'ys', source=map_source, fill_color='custom_color',
+              fill_alpha=0.7, line_color="gray", line_width=0.5)
+    p.add_tools(HoverTool(tooltips=[("Country", "@ADMIN"), (f"Exports ({value_type})", "@exports{0,0.0}")]))
+    color_mapper = LinearColorMapper(palette=smooth_palette, low=frames.low[t], high=frames.high[t], nan_color="#dddddd")
+    p.add_layout(ColorBar(color_mapper=color_mapper, label_standoff=12, title=f"Exports {exp_type}, {value_type}"), 'right')
+
+    world = figure(title=f"World Monthly Auto Exports ({exp_type}, {value_type})", x_axis_type="datetime",
+                   height=220, width=600, tools="pan,xwheel_zoom,reset,save")
+    if store.country_index(datastore.WORLD_COUNTRY) >= 0:
+        world.line(store.dates.iloc[:t + 1], store.series(datastore.WORLD_COUNTRY, exp_type, value_type)[:t + 1],
+                   line_width=2, color="#2171b5")
+    world.yaxis.formatter = NumeralTickFormatter(format="0,0.0")
+    world.xaxis.formatter = DatetimeTickFormatter(years="%b-%y", months="%b-%y")
+
+    top = store.rankings(exp_type, value_type).top(t, TOP_N)
+    top_source = ColumnDataSource(data=dict(country=admin[top].tolist(), value=frames.values[t][top].tolist()))
+    top_chart = figure(x_range=admin[top].tolist(), height=350, width=370, toolbar_location=None, tools="",
+                       title=f"Top {TOP_N} destinations, {title}")
+    top_chart.vbar(x="country", top="value", source=top_source, width=0.7, color="#556B2F", alpha=0.7)
+    top_chart.xaxis.major_label_orientation = 1.0
+    top_chart.xgrid.grid_line_color = None
+    top_chart.title.text_font_size = "14px"
+    top_table = DataTable(source=top_source, width=370, height=350, index_position=None, columns=[
+        TableColumn(field="country", title="Country"),
+        TableColumn(field="value", title=f"Exports ({exp_type}, {value_type})", formatter=NumberFormatter(format="0,0.0")),
+    ])
+    return column(world, row(p, column(top_chart, top_table))), title
+
+
+def render(out_dir, exp_type, value_type, t):
+    store = datastore.get_store()
+    layout, title = build_layout(store, exp_type, value_type, t)
+    theme = Theme(json=theme_json)
+    html_path, json_path = snapshot_paths(out_dir, store, exp_type, value_type, t)
+    os.makedirs(os.path.dirname(html_path), exist_ok=True)
+    _write(html_path, file_html(layout, CDN, f"China Auto Exports, {title}", theme=theme))
+    _write(json_path, json.dumps(json_item(layout, theme=theme)))
+    return exp_type, value_type, t
+
+
+def _write(path, text):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def read_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(out_dir, manifest):
+    _write(os.path.join(out_dir, MANIFEST_NAME), json.dumps(manifest, indent=1, sort_keys=True))
+
+
+def plan(store, out_dir, manifest, export_types, value_types, months, force=False):
+    # (key, digest, combination) for every snapshot that needs rendering.
+    geometry_digest = _geometry_digest(store)
+    todo = []
+    for exp_type in export_types:
+        for value_type in value_types:
+            for t in months:
+                html_path, json_path = snapshot_paths(out_dir, store, exp_type, value_type, t)
+                key = os.path.relpath(html_path, out_dir)[:-len('.html')]
+                digest = snapshot_digest(store, geometry_digest, exp_type, value_type, t)
+                fresh = manifest.get(key) == digest and os.path.exists(html_path) and os.path.exists(json_path)
+                if force or not fresh:
+                    todo.append((key, digest, (exp_type, value_type, t)))
+    return todo
+
+
+def _pool_context():
+    # Fork where available so workers start with the parent's loaded store.
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('fork' if 'fork' in methods else None)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Render static HTML/JSON snapshots of the charts.")
+    parser.add_argument('--out', default='snapshots')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--type', action='append', dest='types', help="export type (repeatable, default all)")
+    parser.add_argument('--value-type', action='append', dest='value_types', help="value type (repeatable, default all)")
+    parser.add_argument('--since', help="first month to render, YYYY-MM")
+    parser.add_argument('--force', action='store_true', help="re-render everything")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    store = datastore.get_store()
+    export_types = args.types or store.export_types
+    value_types = args.value_types or store.value_type_options
+    for name, chosen, options in (('type', export_types, store.export_types),
+                                  ('value type', value_types, store.value_type_options)):
+        unknown = sorted(set(chosen) - set(options))
+        if unknown:
+            sys.exit(f"Unknown {name}: {', '.join(unknown)}")
+    months = [t for t in range(len(store.dates)) if not args.since or month_label(store, t) >= args.since]
+
+    # Build the shared frames and rankings before forking, so workers do
+    # not each compute them again.
+    manifest = read_manifest(args.out)
+    todo = plan(store, args.out, manifest, export_types, value_types, months, args.force)
+    for exp_type in export_types:
+        for value_type in value_types:
+            store.rankings(exp_type, value_type)
+    log.info("%d of %d snapshots to render", len(todo), len(export_types) * len(value_types) * len(months))
+    if not todo:
+        return
+
+    os.makedirs(args.out, exist_ok=True)
+    digests = {combination: (key, digest) for key, digest, combination in todo}
+    done = 0
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=_pool_context(),
+                             initializer=datastore.get_store) as pool:
+        futures = [pool.submit(render, args.out, *combination) for _, _, combination in todo]
+        try:
+            for future in as_completed(futures):
+                key, digest = digests[future.result()]
+                manifest[key] = digest
+                done += 1
+                if done % 100 == 0:
+                    log.info("rendered %d/%d", done, len(todo))
+                    write_manifest(args.out, manifest)
+        finally:
+            # Keep what finished, so an interrupted run resumes where it stopped.
+            write_manifest(args.out, manifest)
+    log.info("rendered %d snapshots into %s", done, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import matplotlib.colors as mcolors
+
+# Look shared by the app and the static snapshots (snapshots.py).
+
+# --- THEME ---
+theme_json = {
+    'attrs': {
+        'figure': {
+            'background_fill_color': '#228B22',
+            'background_fill_alpha': 0.05,
+        },
+        'Axis': {
+            'axis_label_text_font': 'Georgia',
+            'major_label_text_font': 'Georgia',
+        },
+        'Title': {
+            'text_font_style': 'bold',
+            'text_font': 'Georgia',
+            'text_font_size': '18px',
+        },
+        'Legend': {
+            'label_text_font': 'Georgia',
+            'padding': 1,
+            'spacing': 1,
+            'background_fill_alpha': 0.7,
+        },
+    }
+}
+
+# --- PALETTE ---
+blues = [
+    "#c6dbef", "#9ecae1", "#6baed6", "#4292c6", "#2171b5", "#08519c", "#08306b"
+]
+greens = [
+    "#c7e9c0", "#a1d99b", "#74c476", "#41ab5d", "#238b45", "#006d2c", "#00441b"
+]
+palette = blues[::-1] + greens
+def interpolate_palette(palette, n):
+    cmap = mcolors.LinearSegmentedColormap.from_list('custom', palette)
+    return [mcolors.to_hex(cmap(i/(n-1))) for i in range(n)]
+smooth_palette = interpolate_palette(palette, 50)
@@ -0,0 +1,108 @@
+import argparse
+import os
+import shutil
+import sys
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+import datastore
+from matching import NAME_COLUMNS
+
+# Synthetic data directory for benchmarks and load tests, scaled up from the
+# real data:
+#
+#   python app/synthdata.py --out /tmp/synth --countries 4 --months 3
+#   AUTO_EXPORTS_DATA_DIR=/tmp/synth python app/bench.py
+#
+# `--countries k` adds k - 1 copies of every matched country, named
+# "<ADMIN> #2" and so on, with the shape shifted by 360 degrees per copy so
+# the copies tile side by side and still form a valid coverage. Their series
+# are the original (merged) series with multiplicative noise. `--months m`
+# prepends (m - 1) times the original history, again with noise. Everything
+# else (World, unmatched series, region columns) is carried over, so the
+# output loads like the real data.
+
+NOISE = 0.15
+
+
+def noisy(values, rng):
+    return values * rng.lognormal(0.0, NOISE, size=values.shape)
+
+
+def scale_world(world, copies):
+    # Shapes of the matched countries, `copies` times over.
+    shapes = [world]
+    for j in range(2, copies + 1):
+        copy = world.copy()
+        names = copy['ADMIN'] + f' #{j}'
+        for column in NAME_COLUMNS:
+            if column in copy.columns:
+                copy[column] = names
+        copy['geometry'] = shapely.transform(copy.geometry.values, lambda xy: xy + [360.0 * (j - 1), 0.0])
+        shapes.append(copy)
+    return gpd.GeoDataFrame(pd.concat(shapes, ignore_index=True), crs=world.crs)
+
+
+def scale_csv(store, df, copies, months, rng):
+    # Original columns plus one column per (copy, export type, value type),
+    # then `months` times as many rows, the older ones derived from the
+    # original history.
+    columns = {}
+    admins = store.world['ADMIN'].to_numpy()
+    matched = np.flatnonzero(store.world_rows >= 0)
+    for j in range(2, copies + 1):
+        for i in matched:
+            for e, exp_type in enumerate(store.export_types):
+                for v, value_type in enumerate(store.value_types):
+                    values = store.cube[:, store.world_rows[i], e, v].astype(float)
+                    if not np.isnan(values).all():
+                        columns[f'Exports, Autos, {exp_type}, {admins[i]} #{j}, {value_type}'] = noisy(values, rng)
+    scaled = pd.concat([df.reset_index(drop=True), pd.DataFrame(columns)], axis=1)
+    values = scaled.to_numpy(dtype=float)
+    history = [noisy(values, rng) for _ in range(months - 1)] + [values]
+    values = np.concatenate(history)
+    dates = pd.date_range(end=store.dates.iloc[-1], periods=len(values), freq='MS')
+    out = pd.DataFrame(values, columns=scaled.columns)
+    out.insert(0, store.date_col or 'Date', dates.strftime('%Y-%m-%d'))
+    return out
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Write a scaled-up synthetic copy of the data directory.")
+    parser.add_argument('--out', required=True, help="output data directory")
+    parser.add_argument('--countries', type=int, default=2, help="copies of every matched country (>= 1)")
+    parser.add_argument('--months', type=int, default=2, help="multiple of the monthly history (>= 1)")
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.countries < 1 or args.months < 1:
+        sys.exit("--countries and --months must be at least 1")
+    out = os.path.abspath(args.out)
+    if out == os.path.abspath(datastore.DATA_DIR):
+        sys.exit("--out must not be the data directory it reads from")
+    rng = np.random.default_rng(args.seed)
+    store = datastore.load()
+    world = gpd.read_file(datastore.SHAPEFILE_PATH, include_fields=datastore.WORLD_COLUMNS)
+    world = world[world['ADMIN'].isin(store.world['ADMIN'][store.world_rows >= 0])]
+    df = pd.read_csv(datastore.CSV_PATH)
+    date_col = store.date_col or 'Date'
+    df = df.drop(columns=[date_col]) if date_col in df.columns else df
+
+    os.makedirs(out, exist_ok=True)
+    scale_world(world, args.countries).to_file(
+        os.path.join(out, os.path.basename(datastore.SHAPEFILE_PATH)), encoding='utf-8')
+    scale_csv(store, df, args.countries, args.months, rng).to_csv(
+        os.path.join(out, os.path.basename(datastore.CSV_PATH)), index=False)
+    if os.path.exists(datastore.ALIASES_PATH):
+        shutil.copy(datastore.ALIASES_PATH, out)
+    print(f"wrote {out}: {len(world) * args.countries} shapes, {len(store.dates) * args.months} months")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The app's modules import each other by plain name, as `bokeh serve app`
+# runs them.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
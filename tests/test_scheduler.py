@@ -0,0 +1,107 @@
+import asyncio
+import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import scheduler as scheduler_module
+from scheduler import Update, UpdateScheduler
+
+
+@pytest.fixture(autouse=True)
+def executor(monkeypatch):
+    # Two workers, so a blocked compute does not hold up the next one on a
+    # single-CPU machine.
+    pool = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(scheduler_module, 'executor', pool)
+    yield pool
+    pool.shutdown(wait=False)
+
+
+class FakeDocument:
+    # The document callbacks the scheduler uses, run when the test says so.
+    def __init__(self):
+        self.callbacks = []
+
+    def add_next_tick_callback(self, callback):
+        self.callbacks.append(callback)
+        return callback
+
+    def add_timeout_callback(self, callback, delay_ms):
+        return self.add_next_tick_callback(callback)
+
+    def remove_timeout_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def hold(self, policy):
+        pass
+
+    def unhold(self):
+        pass
+
+    def on_change(self, callback):
+        pass
+
+    def remove_on_change(self, callback):
+        pass
+
+    async def run_callbacks(self):
+        # Runs queued callbacks; coroutines (the compute steps) are started
+        # and left running.
+        tasks = []
+        while self.callbacks:
+            result = self.callbacks.pop(0)()
+            if inspect.isawaitable(result):
+                tasks.append(asyncio.ensure_future(result))
+            await asyncio.sleep(0.01)
+        return tasks
+
+
+def test_reset_drops_older_highlight():
+    # Highlight starts computing, a reset is clicked and applied, and only
+    # then does the highlight's result come back: it must not be applied.
+    applied = []
+    release = threading.Event()
+
+    def slow_top15():
+        release.wait(5)
+        return 'top15'
+    highlight = Update(tuple, slow_top15, applied.append, name='highlight')
+    reset = Update(tuple, lambda: 'reset', applied.append, name='reset')
+
+    async def scenario():
+        doc = FakeDocument()
+        scheduler = UpdateScheduler(doc)
+        scheduler.supersede(reset, highlight)
+        scheduler.supersede(highlight, reset)
+        scheduler.request(highlight, debounce=False)
+        highlight_tasks = await doc.run_callbacks()
+        scheduler.request(reset, debounce=False)
+        await asyncio.gather(*await doc.run_callbacks())
+        await doc.run_callbacks()
+        assert applied == ['reset']
+        release.set()
+        await asyncio.gather(*highlight_tasks)
+        await doc.run_callbacks()
+        assert not scheduler.requested(highlight) and not scheduler.requested(reset)
+
+    asyncio.run(scenario())
+    assert applied == ['reset']
+
+
+def test_highlight_after_reset_still_applies():
+    applied = []
+    highlight = Update(tuple, lambda: 'top15', applied.append, name='highlight')
+    reset = Update(tuple, lambda: 'reset', applied.append, name='reset')
+
+    async def scenario():
+        doc = FakeDocument()
+        scheduler = UpdateScheduler(doc)
+        scheduler.supersede(reset, highlight)
+        scheduler.request(reset, highlight, debounce=False)
+        await asyncio.gather(*await doc.run_callbacks())
+        await doc.run_callbacks()
+
+    asyncio.run(scenario())
+    assert applied == ['reset', 'top15']
@@ -0,0 +1,40 @@
+import warnings
+
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+
+import datastore
+
+
+@pytest.fixture(scope='module')
+def world():
+    # Natural Earth 1:110m countries as shipped with geopandas: a real
+    # coverage with long shared borders and many small islands.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        try:
+            path = gpd.datasets.get_path('naturalearth_lowres')
+        except (AttributeError, ValueError):
+            pytest.skip("naturalearth_lowres is not available")
+    return gpd.read_file(path)
+
+
+@pytest.mark.parametrize('name, tolerance', [(name, tol) for name, tol, _ in datastore.LEVELS_OF_DETAIL if tol > 0])
+def test_country_areas_are_kept(world, name, tolerance):
+    geoms = world.geometry.to_numpy()
+    ratio = shapely.area(datastore._simplify_coverage(geoms, tolerance)) / shapely.area(geoms)
+    off = np.abs(ratio - 1) > datastore.COVERAGE_AREA_RTOL
+    assert not off.any(), dict(zip(world['name'][off], ratio[off].round(2)))
+
+
+@pytest.mark.parametrize('tolerance', [tol for _, tol, _ in datastore.LEVELS_OF_DETAIL if tol > 0])
+def test_neighbours_stay_edge_to_edge(world, tolerance):
+    # Shared borders are simplified once, so simplified countries neither
+    # overlap nor leave gaps where they met.
+    simplified = datastore._simplify_coverage(world.geometry.to_numpy(), tolerance)
+    assert shapely.area(simplified).sum() == pytest.approx(shapely.area(shapely.union_all(simplified)), rel=1e-9)
+    russia, = simplified[world['name'] == 'Russia']
+    north_korea, = simplified[world['name'] == 'North Korea']
+    assert shapely.length(shapely.intersection(russia, north_korea)) > 0